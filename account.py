@@ -23,12 +23,18 @@ import logging
 import base64
 import os
 import json
+import socket
+import struct
+import time
+import hashlib
+import tempfile
+import Queue
+from collections import OrderedDict
 import telepathy
 import dbus
 import websocket
-import tempfile
-from zipfile import ZipFile
-from threading import Thread
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from threading import Thread, Lock
 
 from gi.repository import Gtk
 from gi.repository import GObject
@@ -39,11 +45,14 @@ from sugar3.graphics.icon import Icon
 from sugar3.graphics.menuitem import MenuItem
 from sugar3.presence import presenceservice
 from sugar3 import profile
+from sugar3 import env
 
 try:
     from sugar3.presence.wrapper import CollabWrapper
+    # the wrapper of the toolkit only sends json.
+    CompactCodec = None
 except ImportError:
-    from textchannelwrapper import CollabWrapper
+    from textchannelwrapper import CollabWrapper, CompactCodec
 
 from jarabe.journal import journalwindow
 from jarabe.journal import model
@@ -54,10 +63,66 @@ ACCOUNT_NAME = _('Teacher')
 ACCOUNT_ICON = 'female-7'
 TARGET = 'org.sugarlabs.JournalShare'
 JOURNAL_STREAM_SERVICE = 'journal-activity-http'
+# threads packaging and hashing journal entries off the main loop.
+WORKER_THREADS = 2
+# jobs waiting for a worker thread before more are refused.
+MAX_QUEUED_JOBS = 256
+# directory of the package cache, in the profile of the user.
+PACKAGE_CACHE_DIR = 'teachershare-packages'
+# bytes of packaged entries kept for repeat shares.
+PACKAGE_CACHE_BUDGET = 64 * 1024 * 1024
 CHUNK_SIZE = 2048
+MAX_CHUNK_SIZE = 1 << 20
+
+# chunks in flight before waiting for an acknowledgement.
+UPLOAD_WINDOW = 8
+# the chunk size grows while acks come back faster than this (seconds),
+# and shrinks when they are slower.
+TARGET_RTT = 0.2
+# seconds to wait for an acknowledgement before resuming the upload on
+# a new connection.
+ACK_TIMEOUT = 30
+# failed attempts in a row, without any progress, before giving up.
+UPLOAD_RETRIES = 5
+RETRY_DELAY = 1
+# seconds an unused upload connection is kept open.
+CONNECTION_MAX_IDLE = 120
+# seconds between the checks of the unused connections, which close the
+# expired ones and ping the others to keep them open.
+CONNECTION_CHECK_INTERVAL = 30
+# seconds to wait for the pong of an idle connection before reusing it.
+PING_TIMEOUT = 2
+# seconds to wait for the server to answer the upload modes offered.
+# servers that did not answer in time are not waited for again.
+NEGOTIATE_TIMEOUT = 2
+CONNECT_RETRIES = 3
+
+# how the data of a journal entry is stored in the package, by mime type.
+# a mime type matches its exact entry, then "major/*", then "*".
+COMPRESSION_POLICY = {
+    'text/*': ZIP_DEFLATED,
+    'application/json': ZIP_DEFLATED,
+    'application/vnd.olpc-sugar': ZIP_DEFLATED,
+    'image/jpeg': ZIP_STORED,
+    'image/png': ZIP_STORED,
+    'audio/*': ZIP_STORED,
+    'video/*': ZIP_STORED,
+    '*': ZIP_STORED,
+}
 
 JOIN_CMD = "j"
 CLOSE_CMD = "c"
+CHUNK_CMD = "k"
+ACK_CMD = "a"
+METADATA_CMD = "m"
+
+# fields of the upload events posted to the buddies, by command.
+EVENT_SCHEMAS = [(JOIN_CMD, ['nick']), (CLOSE_CMD, ['nick', 'mode'])]
+
+# upload modes offered to the JournalShare server, in order of preference.
+BINARY_MODE = "binary"
+BASE64_MODE = "base64"
+UPLOAD_MODES = [BINARY_MODE, BASE64_MODE]
 
 
 class Account(account.Account):
@@ -67,6 +132,16 @@ class Account(account.Account):
         self._model = neighborhood.get_model()
         self.unused_download_tubes = set()
         self.url_cache = None
+        try:
+            self.package_cache = PackageCache(
+                env.get_profile_path(PACKAGE_CACHE_DIR),
+                PACKAGE_CACHE_BUDGET)
+        except OSError, e:
+            logging.error('Cannot use the package cache: %s', e)
+            # without a budget the packages are removed once uploaded.
+            self.package_cache = PackageCache(tempfile.mkdtemp(), 0)
+        self.worker_pool = WorkerPool(WORKER_THREADS)
+        self.connection_pool = ConnectionPool(CONNECTION_MAX_IDLE)
 
     def get_description(self):
         return ACCOUNT_NAME
@@ -162,6 +237,10 @@ class _ShareMenu(MenuItem):
         self._shared_activity = None
         self._join_id = None
         self._tubes_chan = None
+        self._jobjects = []
+        self._prepare_jobs = []
+        self._prepared = {}
+        self._url = None
 
         self.set_image(Icon(icon_name=ACCOUNT_ICON,
                             icon_size=Gtk.IconSize.MENU))
@@ -187,8 +266,8 @@ class _ShareMenu(MenuItem):
                 return True
         return False
 
-    def _get_metadata(self):
-        return model.get(self._get_uid_list()[0])
+    def _get_metadata_list(self):
+        return [model.get(uid) for uid in self._get_uid_list()]
 
     def __share_menu_cb(self, menu_item):
         if self._account.url_cache is None:
@@ -305,47 +384,108 @@ class _ShareMenu(MenuItem):
 
             logging.debug('http://%s:%d/web/index.html' % (ip, port))
 
-        metadata = self._get_metadata()
-
-        self._jobject = datastore.get(metadata['uid'])
-        # Add the information about the user uploading this object
+        self._cancel_prepare()
+        self._jobjects = []
         user_data = get_user_data()
-        self._jobject.metadata['shared_by'] = json.dumps(user_data)
-        # And add a comment to the Journal entry
-        if 'comments' in self._jobject.metadata:
-            comments = json.loads(self._jobject.metadata['comments'])
-        else:
-            comments = []
-        comments.append({'from': user_data['from'],
-                         'message': _('I shared this.'),
-                         'icon-color': '[%s,%s]' % (
-                             user_data['icon'][0], user_data['icon'][1])})
-        self._jobject.metadata['comments'] = json.dumps(comments)
-
-        if self._jobject and self._jobject.file_path:
-            tmp_path = '/tmp'
-            packaged_file_path = package_ds_object(self._jobject, tmp_path)
+        for metadata in self._get_metadata_list():
+            jobject = datastore.get(metadata['uid'])
+            if jobject and jobject.file_path:
+                _add_share_comment(jobject, user_data)
+                self._jobjects.append(jobject)
+
+        if self._jobjects:
             if self._account.url_cache is None:
                 url = 'ws://%s:%d/websocket/upload' % (ip, port)
                 self._account.url_cache = url
             else:
                 url = self._account.url_cache
             logging.debug('url is %s' % (url))
-            uploader = Uploader(packaged_file_path, url)
-            uploader.connect('uploaded', self.__uploaded_cb)
-            self.emit('transfer-state-changed', _('Upload started'))
-            uploader.start()
+            self._url = url
+            # Packaging and hashing a big entry takes a while, so it is
+            # done by the worker pool instead of the main loop.  The
+            # entries are packaged in parallel and uploaded in order
+            # over a single connection.
+            self.emit('transfer-state-changed', _('Preparing upload'))
+            for index, jobject in enumerate(self._jobjects):
+                try:
+                    job = self._account.worker_pool.submit(
+                        prepare_upload, self._account.package_cache,
+                        jobject, result_cb=self.__upload_prepared_cb,
+                        error_cb=self.__upload_prepare_error_cb,
+                        discard_cb=self.__upload_discarded_cb)
+                except WorkerPoolFull:
+                    logging.error('Too many journal entries to package')
+                    self._cancel_prepare()
+                    self.emit('transfer-state-changed', _('Upload failed'))
+                    break
+                job.index = index
+                self._prepare_jobs.append(job)
 
         return False
 
-    def __uploaded_cb(self, uploader, xfer_successful):
+    def __upload_prepared_cb(self, job, result):
+        if job not in self._prepare_jobs:
+            self.__upload_discarded_cb(job, result)
+            return
+        self._prepared[job.index] = result
+        self.emit('transfer-state-changed',
+                  _('Preparing upload (%d of %d)') % (
+                      len(self._prepared), len(self._jobjects)))
+        if len(self._prepared) < len(self._jobjects):
+            return
+        self._prepare_jobs = []
+
+        uploader = None
+        file_paths = []
+        for index in range(len(self._jobjects)):
+            packaged_file_path, content_hash, data_hash = \
+                self._prepared.pop(index)
+            file_paths.append(packaged_file_path)
+            if uploader is None:
+                uploader = Uploader(
+                    packaged_file_path, self._url,
+                    content_hash=content_hash, data_hash=data_hash,
+                    connection_pool=self._account.connection_pool)
+            else:
+                uploader.add_package(packaged_file_path, content_hash,
+                                     data_hash)
+        # the packages stay pinned in the cache until they are uploaded.
+        uploader.connect('uploaded', self.__uploaded_cb, file_paths)
+        self.emit('transfer-state-changed', _('Upload started'))
+        uploader.start()
+
+    def __upload_prepare_error_cb(self, job, error):
+        if job not in self._prepare_jobs:
+            return
+        self._cancel_prepare()
+        logging.error('Cannot package journal entry: %s', error)
+        self.emit('transfer-state-changed', _('Upload failed'))
+
+    def __upload_discarded_cb(self, job, result):
+        self._account.package_cache.release(result[0])
+
+    def _cancel_prepare(self):
+        for job in self._prepare_jobs:
+            job.cancel()
+        self._prepare_jobs = []
+        self._release_prepared()
+
+    def _release_prepared(self):
+        for result in self._prepared.values():
+            self._account.package_cache.release(result[0])
+        self._prepared = {}
+
+    def __uploaded_cb(self, uploader, xfer_successful, file_paths):
+        for file_path in file_paths:
+            self._account.package_cache.release(file_path)
         if xfer_successful:
-            datastore.write(self._jobject,
-                            update_mtime=False,
-                            reply_handler=self.__datastore_write_cb,
-                            error_handler=self.__datastore_write_error_cb)
+            for jobject in self._jobjects:
+                datastore.write(jobject,
+                                update_mtime=False,
+                                reply_handler=self.__datastore_write_cb,
+                                error_handler=self.__datastore_write_error_cb)
+                self.emit('comments-changed', jobject.metadata['comments'])
             self.emit('transfer-state-changed', _('Upload completed'))
-            self.emit('comments-changed', self._jobject.metadata['comments'])
         else:
             self.emit('transfer-state-changed', _('Upload failed'))
 
@@ -359,6 +499,10 @@ class _ShareMenu(MenuItem):
 # From JournalShare/utils.py
 
 
+# urls of the servers that did not answer the upload modes offered.
+_silent_servers = set()
+
+
 class Uploader(GObject.GObject):
 
     __gsignals__ = {
@@ -367,46 +511,719 @@ class Uploader(GObject.GObject):
                                    ([str]))
     }
 
-    def __init__(self, file_path, url):
+    def __init__(self, file_path, url, modes=UPLOAD_MODES,
+                 window=UPLOAD_WINDOW, content_hash=None, data_hash=None,
+                 connection_pool=None):
         GObject.GObject.__init__(self)
         logging.debug('websocket url %s', url)
-        # base64 encode the file
-        self._file = tempfile.TemporaryFile(mode='r+')
-        base64.encode(open(file_path, 'r'), self._file)
-        self._file.seek(0)
+        self._url = url
+        self._modes = modes
+        self._nick = profile.get_nick_name()
+        self._connection_pool = connection_pool
+        # [file path, hash, data hash] of the packages not uploaded yet.
+        self._pending = []
+        self.add_package(file_path, content_hash, data_hash)
+        self._file_path = None
+        self._size = 0
+        self.window = window
+        self.chunk_size = CHUNK_SIZE
+        self.content_hash = None
+        self.data_hash = None
+        # True when the server already had the data and only the
+        # metadata was sent.
+        self.deduplicated = False
+        self.mode = None
+        # bytes acknowledged by the server so far.
+        self.offset = 0
 
         self.buddies = {}
 
-        self.collab = CollabWrapper(self)
+        if CompactCodec is None:
+            self.collab = CollabWrapper(self)
+        else:
+            self.collab = CollabWrapper(
+                self, codec=CompactCodec(EVENT_SCHEMAS))
         self.collab.message.connect(self._on_message)
         self.collab.setup()
 
-        self._chunk = str(self._file.read(CHUNK_SIZE))
-
-        self.start()
+    def add_package(self, file_path, content_hash=None, data_hash=None):
+        """
+        Queue another package to be uploaded after the previous ones,
+        over the same connection.  Call it before start.
+        """
+        self._pending.append([file_path, content_hash, data_hash])
 
     def start(self):
-        self.collab.send(JOIN_CMD, {"nick": profile.get_nick_name(), "chunk": self._chunk})
+        self.send_event(JOIN_CMD, {"nick": self._nick})
+        upload_thread = Thread(target=self._upload)
+        upload_thread.daemon = True
+        upload_thread.start()
+
+    def _upload(self):
+        attempt = 0
+        while self._pending:
+            progress = (len(self._pending), self.offset)
+            try:
+                self._upload_once()
+            except (IOError, socket.error, websocket.WebSocketException), e:
+                if (len(self._pending), self.offset) != progress:
+                    attempt = 0
+                attempt += 1
+                if attempt > UPLOAD_RETRIES:
+                    logging.error('upload of %s failed: %s',
+                                  self._file_path, e)
+                    GObject.idle_add(self.emit, 'uploaded', False)
+                    return
+                logging.debug('upload interrupted at %d: %s, resuming',
+                              self.offset, e)
+                time.sleep(RETRY_DELAY * attempt)
+        # the collab wrapper is only used from the main loop.
+        GObject.idle_add(self._on_close, None)
+
+    def _upload_once(self):
+        if self._connection_pool is None:
+            ws = websocket.create_connection(self._url,
+                                             permessage_deflate=True)
+            try:
+                self._upload_pending(ws)
+            finally:
+                ws.close()
+            return
+
+        ws = self._connection_pool.acquire(self._url)
+        try:
+            self._upload_pending(ws)
+        except:
+            self._connection_pool.discard(ws)
+            raise
+        self._connection_pool.release(self._url, ws)
+
+    def _upload_pending(self, ws):
+        while self._pending:
+            self._load_package(self._pending[0])
+            self._upload_package(ws)
+            self._pending.pop(0)
+
+    def _load_package(self, package):
+        file_path, content_hash, data_hash = package
+        if content_hash is None:
+            package[1] = content_hash = get_file_hash(file_path)
+        if data_hash is None:
+            package[2] = data_hash = get_data_hash(file_path)
+        if file_path != self._file_path:
+            self._file_path = file_path
+            self._size = os.path.getsize(file_path)
+            self.offset = 0
+        self.content_hash = content_hash
+        self.data_hash = data_hash
+
+    def _upload_package(self, ws):
+        reply = self._negotiate(ws)
+        self.deduplicated = bool(reply.get("have"))
+        if self.deduplicated:
+            logging.debug('server has the data of %s already',
+                          self._file_path)
+            self._send_metadata(ws)
+        else:
+            logging.debug('uploading %s in %s mode', self._file_path,
+                          self.mode)
+            self._send_package(ws, reply)
+        ws.send(json.dumps({"cmd": CLOSE_CMD, "nick": self._nick,
+                            "hash": self.content_hash}))
+
+    def _send_package(self, ws, reply):
+        with open(self._file_path, 'rb') as data_file:
+            if 'offset' in reply:
+                self._send_chunks(ws, data_file, reply['offset'])
+            # the server does not know the chunk protocol.
+            elif self.mode == BINARY_MODE:
+                ws.send_stream(data_file, websocket.ABNF.OPCODE_BINARY)
+            else:
+                _send_base64(ws, data_file)
+
+    def _send_metadata(self, ws):
+        with ZipFile(self._file_path) as package:
+            msg = {"cmd": METADATA_CMD, "data_hash": self.data_hash,
+                   "metadata": package.read('metadata')}
+            if 'preview' in package.namelist():
+                msg["preview"] = base64.b64encode(package.read('preview'))
+        ws.send(json.dumps(msg))
+
+    def _negotiate(self, ws):
+        """
+        Offer the upload modes to the JournalShare server and return its
+        reply.  Servers that do not answer with a mode only understand
+        base64 text.  Servers that answer with an offset already have
+        that many bytes of this content, and acknowledge every chunk.
+        Servers that answer "have" already hold data with the same hash,
+        so only the metadata needs to be sent.  Servers that do not
+        answer within NEGOTIATE_TIMEOUT seconds are treated like those
+        that do not answer with a mode, and are not waited for again.
+        """
+        ws.send(json.dumps({"cmd": JOIN_CMD, "nick": self._nick,
+                            "modes": self._modes,
+                            "size": self._size,
+                            "hash": self.content_hash,
+                            "data_hash": self.data_hash}))
+        if self._url in _silent_servers:
+            reply = {}
+        else:
+            reply = self._wait_reply(ws)
+        if not isinstance(reply, dict):
+            reply = {}
+        self.mode = reply.get("mode")
+        if self.mode not in self._modes:
+            self.mode = BASE64_MODE
+        return reply
+
+    def _wait_reply(self, ws):
+        timeout = ws.gettimeout()
+        ws.settimeout(NEGOTIATE_TIMEOUT)
+        try:
+            return json.loads(ws.recv())
+        except (TypeError, ValueError):
+            return {}
+        except socket.timeout:
+            logging.debug('no upload mode from the server, using %s',
+                          BASE64_MODE)
+            _silent_servers.add(self._url)
+            return {}
+        finally:
+            ws.settimeout(timeout)
+
+    def _send_chunks(self, ws, data_file, offset):
+        self.offset = offset
+        data_file.seek(offset)
+        # (end offset, send time) of every chunk not acknowledged yet.
+        in_flight = []
+        # a server that stops acknowledging raises socket.timeout, and
+        # the upload resumes on a new connection.
+        timeout = ws.gettimeout()
+        ws.settimeout(ACK_TIMEOUT)
+        try:
+            while self.offset < self._size:
+                while offset < self._size and len(in_flight) < self.window:
+                    data = data_file.read(self.chunk_size)
+                    if not data:
+                        raise IOError('%s was truncated' % self._file_path)
+                    self._send_chunk(ws, offset, data)
+                    offset += len(data)
+                    in_flight.append((offset, time.time()))
+                self._wait_ack(ws, in_flight)
+        finally:
+            ws.settimeout(timeout)
+
+    def _send_chunk(self, ws, offset, data):
+        if self.mode == BINARY_MODE:
+            ws.send(struct.pack('!Q', offset) + data,
+                    websocket.ABNF.OPCODE_BINARY)
+        else:
+            ws.send(json.dumps({"cmd": CHUNK_CMD, "offset": offset,
+                                "data": base64.b64encode(data)}))
+
+    def _wait_ack(self, ws, in_flight):
+        while True:
+            message = ws.recv()
+            if message is None:
+                raise websocket.WebSocketException('closed by the server')
+            try:
+                msg = json.loads(message)
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and msg.get("cmd") == ACK_CMD:
+                break
+
+        ack = msg.get("offset", 0)
+        rtt = None
+        while in_flight and in_flight[0][0] <= ack:
+            rtt = time.time() - in_flight.pop(0)[1]
+        self.offset = max(self.offset, ack)
+        if rtt is not None:
+            self._adapt_chunk_size(rtt)
+
+    def _adapt_chunk_size(self, rtt):
+        if rtt < TARGET_RTT / 2:
+            self.chunk_size = min(self.chunk_size * 2, MAX_CHUNK_SIZE)
+        elif rtt > TARGET_RTT:
+            self.chunk_size = max(self.chunk_size // 2, CHUNK_SIZE)
 
     def _on_message(self, collab, buddy, msg):
         command = msg.get("cmd")
 
         if command == JOIN_CMD:
-            self.buddies[msg.get("nick")] = msg.get("chunk")
+            self.buddies[msg.get("nick")] = msg.get("mode")
 
         elif command == CLOSE_CMD:
             del self.buddies[msg.get("nick")]
 
     def _on_close(self, ws):
-        self._file.close()
-        self.send_event(CLOSE_CMD, {"nick": profile.get_nick_name(), "chunk": self._chunk})
-        GObject.idle_add(self.emit, 'uploaded', True)
+        self.send_event(CLOSE_CMD, {"nick": self._nick, "mode": self.mode})
+        self.emit('uploaded', True)
+        return False
 
     def send_event(self, msg, payload={}):
         payload["cmd"] = msg
         self.collab.post(payload)
 
 
+class ConnectionPool(object):
+    """
+    Keeps upload connections open between shares, so that the next share
+    to the same url skips the TCP and WebSocket handshakes.  An idle
+    connection is checked with a ping before it is reused, and closed
+    once it has been idle for max_idle seconds.  While there are idle
+    connections, a timer on the main loop starts a thread every
+    CONNECTION_CHECK_INTERVAL seconds that closes the expired ones and
+    pings the others.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        # url -> [(connection, time it was released)]
+        self._idle = {}
+        self._lock = Lock()
+        self._check_id = None
+        self.handshakes = 0
+        self.handshake_seconds = 0.0
+        self.reuses = 0
+
+    def acquire(self, url):
+        """
+        Return an open connection to url, reusing an idle one if it is
+        still alive.
+        """
+        while True:
+            with self._lock:
+                expired = self._take_expired()
+                idle = self._idle.get(url)
+                ws = idle.pop()[0] if idle else None
+            for expired_ws in expired:
+                self.discard(expired_ws)
+            if ws is None:
+                break
+            if self._is_alive(ws):
+                with self._lock:
+                    self.reuses += 1
+                return ws
+            self.discard(ws)
+        return self._connect(url)
+
+    def release(self, url, ws):
+        """
+        Give back a connection that is still usable.
+        """
+        with self._lock:
+            self._idle.setdefault(url, []).append((ws, time.time()))
+            expired = self._take_expired()
+            if self._check_id is None:
+                self._check_id = GObject.timeout_add_seconds(
+                    CONNECTION_CHECK_INTERVAL, self.__check_cb)
+        for expired_ws in expired:
+            self.discard(expired_ws)
+
+    def discard(self, ws):
+        """
+        Close a connection that failed instead of giving it back.
+        """
+        try:
+            ws.close()
+        except (socket.error, websocket.WebSocketException):
+            pass
+
+    def get_stats(self):
+        with self._lock:
+            handshakes = self.handshakes
+            reuses = self.reuses
+            handshake_seconds = self.handshake_seconds
+        if handshakes:
+            handshake = handshake_seconds / handshakes
+        else:
+            handshake = 0.0
+        return {'handshakes': handshakes, 'reuses': reuses,
+                'handshake_seconds': handshake,
+                'saved_seconds': handshake * reuses}
+
+    def _connect(self, url):
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                ws = websocket.create_connection(url, permessage_deflate=True)
+            except (socket.error, websocket.WebSocketException), e:
+                attempt += 1
+                if attempt >= CONNECT_RETRIES:
+                    raise
+                logging.debug('cannot connect to %s: %s, retrying', url, e)
+                time.sleep(RETRY_DELAY * 2 ** attempt)
+                continue
+            with self._lock:
+                self.handshakes += 1
+                self.handshake_seconds += time.time() - start
+            return ws
+
+    def _is_alive(self, ws):
+        timeout = ws.gettimeout()
+        try:
+            ws.settimeout(PING_TIMEOUT)
+            ws.ping()
+            while True:
+                frame = ws.recv_frame()
+                if frame is None or \
+                        frame.opcode == websocket.ABNF.OPCODE_CLOSE:
+                    return False
+                if frame.opcode == websocket.ABNF.OPCODE_PONG:
+                    ws.settimeout(timeout)
+                    return True
+        except (socket.error, websocket.WebSocketException):
+            return False
+
+    def __check_cb(self):
+        with self._lock:
+            if not any(self._idle.values()):
+                self._check_id = None
+                return False
+        # the pings wait for their pongs, so not on the main loop.
+        thread = Thread(target=self._check_idle)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _check_idle(self):
+        # the connections are taken out while they are checked, so that
+        # they are not acquired at the same time.
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        now = time.time()
+        for url, connections in idle.items():
+            for ws, released in connections:
+                if now - released > self.max_idle or not self._is_alive(ws):
+                    self.discard(ws)
+                    continue
+                with self._lock:
+                    self._idle.setdefault(url, []).append((ws, released))
+
+    def _take_expired(self):
+        # call with the lock held, and discard the connections returned
+        # once it is released, as closing them waits for the server.
+        now = time.time()
+        expired = []
+        for url, idle in self._idle.items():
+            for ws, released in idle[:]:
+                if now - released > self.max_idle:
+                    idle.remove((ws, released))
+                    expired.append(ws)
+            if not idle:
+                del self._idle[url]
+        return expired
+
+
+def _send_base64(ws, data_file):
+    # every 3 raw bytes encode to 4 base64 characters, so all chunks but
+    # the last one are encoded without padding.
+    while True:
+        data = data_file.read(CHUNK_SIZE // 4 * 3)
+        if not data:
+            break
+        ws.send(base64.b64encode(data))
+
+
+class PackageCache(object):
+    """
+    On-disk cache of packaged journal entries, so that sharing an
+    unchanged entry again does not package it again.  Packages are keyed
+    by object id, size and mtime of the data file and a hash of the
+    metadata, and the least recently used ones are removed once they
+    take more than budget bytes.  The comments are left out of the key,
+    as every share adds one, so a cached package has the comments of the
+    share that created it.  Packages handed out by get_package are
+    pinned until they are released, so that they are not removed while
+    they wait to be uploaded.
+    """
+
+    def __init__(self, path, budget):
+        self._path = path
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        # key -> size of the package, least recently used first.
+        self._entries = OrderedDict()
+        self._size = 0
+        # key -> number of times the package is pinned.
+        self._pins = {}
+        # packages are created by the worker pool threads.
+        self._lock = Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path, 0700)
+        for name in os.listdir(path):
+            if name.endswith('.part'):
+                os.remove(os.path.join(path, name))
+        packages = [name for name in os.listdir(path)
+                    if name.endswith('.journal')]
+        packages.sort(key=lambda name: os.path.getmtime(
+            os.path.join(path, name)))
+        for name in packages:
+            self._add(name[:-len('.journal')])
+        self._evict()
+
+    def get_package(self, dsobj):
+        """
+        Return the path of the package of a journal object, creating it
+        if it is not cached.  The package is pinned until release is
+        called with its path.
+        """
+        key = self._get_key(dsobj)
+        file_path = self._get_path(key)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._pin(key)
+                self._entries[key] = self._entries.pop(key)
+                os.utime(file_path, None)
+                logging.debug('package cache hit for %s', dsobj.object_id)
+                return file_path
+            self.misses += 1
+
+        part_fd, part_path = tempfile.mkstemp('.part', dir=self._path)
+        try:
+            with os.fdopen(part_fd, 'wb') as journal_file:
+                write_ds_object(dsobj, journal_file)
+        except:
+            os.remove(part_path)
+            raise
+        with self._lock:
+            os.rename(part_path, file_path)
+            self._pin(key)
+            if key not in self._entries:
+                self._add(key)
+                self._evict()
+        return file_path
+
+    def release(self, file_path):
+        """
+        Unpin a package returned by get_package once it is not needed.
+        """
+        key = os.path.basename(file_path)[:-len('.journal')]
+        with self._lock:
+            if self._pins.get(key, 0) > 1:
+                self._pins[key] -= 1
+            else:
+                self._pins.pop(key, None)
+                self._evict()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'size': self._size,
+                'pinned': len(self._pins)}
+
+    def _get_key(self, dsobj):
+        stat = os.stat(dsobj.file_path)
+        metadata = dict(dsobj.metadata)
+        metadata.pop('comments', None)
+        # the preview can be raw PNG bytes, which json cannot encode.
+        preview = metadata.pop('preview', '')
+        if isinstance(preview, unicode):
+            preview = preview.encode('utf-8')
+        digest = hashlib.sha1()
+        digest.update(json.dumps([dsobj.object_id, stat.st_size,
+                                  stat.st_mtime, metadata],
+                                 sort_keys=True))
+        digest.update(str(preview))
+        return digest.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._path, key + '.journal')
+
+    def _add(self, key):
+        size = os.path.getsize(self._get_path(key))
+        self._entries[key] = size
+        self._size += size
+
+    def _pin(self, key):
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def _evict(self):
+        # the most recent package is kept even if it is over budget, and
+        # pinned ones are kept until they are released.
+        for key in self._entries.keys()[:-1]:
+            if self._size <= self.budget:
+                break
+            if key in self._pins:
+                continue
+            self._size -= self._entries.pop(key)
+            try:
+                os.remove(self._get_path(key))
+            except OSError, e:
+                logging.error('Cannot remove cached package: %s', e)
+
+
+def prepare_upload(job, package_cache, dsobj):
+    """
+    Worker pool job that packages a journal object and hashes the
+    package.  Returns the package path, its hash and its data hash.  The
+    package stays pinned in the cache until it is released.
+    """
+    file_path = package_cache.get_package(dsobj)
+    try:
+        job.progress(0.5)
+        content_hash = get_file_hash(file_path, job)
+        job.progress(0.75)
+        data_hash = get_data_hash(file_path, job)
+        job.progress(1.0)
+    except:
+        package_cache.release(file_path)
+        raise
+    return file_path, content_hash, data_hash
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class WorkerPoolFull(Exception):
+    pass
+
+
+class _Job(object):
+
+    def __init__(self, func, args, result_cb, error_cb, progress_cb,
+                 discard_cb):
+        self._func = func
+        self._args = args
+        self._result_cb = result_cb
+        self._error_cb = error_cb
+        self._progress_cb = progress_cb
+        self._discard_cb = discard_cb
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stop the job.  A job that has not started will not run, and the
+        result of a running one goes to discard_cb instead of result_cb.
+        """
+        self.cancelled = True
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, fraction):
+        self.check_cancelled()
+        if self._progress_cb is not None:
+            GObject.idle_add(_call_once, self._progress_cb, self, fraction)
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            result = self._func(self, *self._args)
+        except JobCancelled:
+            logging.debug('job %s cancelled', self._func.__name__)
+            return
+        except Exception, e:
+            logging.exception('job %s failed', self._func.__name__)
+            if self._error_cb is not None and not self.cancelled:
+                GObject.idle_add(_call_once, self._error_cb, self, e)
+            return
+        if self.cancelled:
+            callback = self._discard_cb
+        else:
+            callback = self._result_cb
+        if callback is not None:
+            GObject.idle_add(_call_once, callback, self, result)
+
+
+class WorkerPool(object):
+    """
+    Runs jobs on a fixed number of threads so that they do not block the
+    main loop.  Results, errors and progress are passed to the callbacks
+    on the main loop.  At most max_queued jobs wait for a thread.
+    """
+
+    def __init__(self, size, max_queued=MAX_QUEUED_JOBS):
+        self._size = size
+        self._queue = Queue.Queue(max_queued)
+        self._threads = []
+
+    def submit(self, func, *args, **callbacks):
+        """
+        Queue func(job, *args) to run on a worker thread and return the
+        job, which can be cancelled.  func can call job.progress with the
+        fraction done, which also stops it if the job was cancelled.
+        Callbacks: result_cb(result), error_cb(exception),
+        progress_cb(fraction) and discard_cb(result), for the result of a
+        job cancelled after it finished, each called with the job first.
+        Raises WorkerPoolFull if too many jobs are waiting already.
+        """
+        job = _Job(func, args, callbacks.get('result_cb'),
+                   callbacks.get('error_cb'), callbacks.get('progress_cb'),
+                   callbacks.get('discard_cb'))
+        try:
+            self._queue.put_nowait(job)
+        except Queue.Full:
+            raise WorkerPoolFull()
+        if len(self._threads) < self._size:
+            thread = Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return job
+
+    def _work(self):
+        while True:
+            self._queue.get().run()
+
+
+def _call_once(callback, *args):
+    callback(*args)
+    return False
+
+
+def get_file_hash(file_path, job=None):
+    """
+    Return the hex SHA-256 digest of a file, used to identify the
+    content of an upload.
+    """
+    with open(file_path, 'rb') as data_file:
+        return _get_stream_hash(data_file, job)
+
+
+def get_data_hash(file_path, job=None):
+    """
+    Return the hex SHA-256 digest of the data of a journal package,
+    which does not change when only the metadata of the entry does.
+    """
+    with ZipFile(file_path) as package:
+        return _get_stream_hash(package.open('data'), job)
+
+
+def _get_stream_hash(stream, job=None):
+    digest = hashlib.sha256()
+    while True:
+        if job is not None:
+            job.check_cancelled()
+        data = stream.read(1 << 16)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _add_share_comment(jobject, user_data):
+    # Add the information about the user uploading this object
+    jobject.metadata['shared_by'] = json.dumps(user_data)
+    # And add a comment to the Journal entry
+    if 'comments' in jobject.metadata:
+        comments = json.loads(jobject.metadata['comments'])
+    else:
+        comments = []
+    comments.append({'from': user_data['from'],
+                     'message': _('I shared this.'),
+                     'icon-color': '[%s,%s]' % (
+                         user_data['icon'][0], user_data['icon'][1])})
+    jobject.metadata['comments'] = json.dumps(comments)
+
+
 def get_user_data():
     """
     Create this structure:
@@ -427,52 +1244,95 @@ def package_ds_object(dsobj, destination_path):
     Creates a zipped file with the file associated to a journal object,
     the preview and the metadata
     """
+    file_path = os.path.join(destination_path,
+                             'id_' + dsobj.object_id + '.journal')
+    with open(file_path, 'wb') as journal_file:
+        write_ds_object(dsobj, journal_file)
+    return file_path
+
+
+def write_ds_object(dsobj, fileobj, policy=COMPRESSION_POLICY):
+    """
+    Writes the zipped journal object to a file object, which must be
+    seekable.  The metadata and the preview are written from memory and
+    the data file is streamed in, so no temporary files are created.
+    The data is compressed or not according to the policy for its
+    mime type.
+    """
     object_id = dsobj.object_id
     logging.debug('id %s', object_id)
-    preview_path = None
-
-    logging.debug('before preview')
-    if 'preview' in dsobj.metadata:
-        # TODO: copied from expandedentry.py
-        # is needed because record is saving the preview encoded
-        if dsobj.metadata['preview'][1:4] == 'PNG':
-            preview = dsobj.metadata['preview']
-        else:
-            # TODO: We are close to be able to drop this.
-            preview = base64.b64decode(dsobj.metadata['preview'])
-
-        preview_path = os.path.join(destination_path,
-                                    'preview_id_' + object_id)
-        preview_file = open(preview_path, 'w')
-        preview_file.write(preview)
-        preview_file.close()
-
-    logging.debug('before metadata')
-    # create file with the metadata
-    metadata_path = os.path.join(destination_path,
-                                 'metadata_id_' + object_id)
-    metadata_file = open(metadata_path, 'w')
-    metadata = {}
-    for key in dsobj.metadata.keys():
-        if key not in ('object_id', 'preview', 'progress'):
-            metadata[key] = dsobj.metadata[key]
-    metadata['original_object_id'] = dsobj.object_id
-
-    metadata_file.write(json.dumps(metadata))
-    metadata_file.close()
-
-    logging.debug('before create zip')
-
-    # create a zip fileincluding metadata and preview
+    mime_class = get_mime_class(dsobj.metadata.get('mime_type', ''), policy)
+
+    # create a zip including metadata and preview
     # to be read from the web server
-    file_path = os.path.join(destination_path, 'id_' + object_id + '.journal')
+    with ZipFile(fileobj, 'w') as myzip:
+        if 'preview' in dsobj.metadata:
+            # TODO: copied from expandedentry.py
+            # is needed because record is saving the preview encoded
+            if dsobj.metadata['preview'][1:4] == 'PNG':
+                preview = dsobj.metadata['preview']
+            else:
+                # TODO: We are close to be able to drop this.
+                preview = base64.b64decode(dsobj.metadata['preview'])
+            myzip.writestr('preview', preview)
 
-    with ZipFile(file_path, 'w') as myzip:
-        if preview_path is not None:
-            myzip.write(preview_path, 'preview')
-        myzip.write(metadata_path, 'metadata')
-        myzip.write(dsobj.file_path, 'data')
-    return file_path
+        metadata = {}
+        for key in dsobj.metadata.keys():
+            if key not in ('object_id', 'preview', 'progress'):
+                metadata[key] = dsobj.metadata[key]
+        metadata['original_object_id'] = dsobj.object_id
+        myzip.writestr('metadata', json.dumps(metadata), ZIP_DEFLATED)
+
+        start = time.time()
+        myzip.write(dsobj.file_path, 'data',
+                    policy.get(mime_class, ZIP_STORED))
+        _record_compression(mime_class, myzip.getinfo('data'),
+                            time.time() - start)
+
+
+def get_mime_class(mime_type, policy=COMPRESSION_POLICY):
+    """
+    Return the key of the compression policy that applies to a mime type.
+    """
+    if mime_type in policy:
+        return mime_type
+    major_class = mime_type.split('/')[0] + '/*'
+    if major_class in policy:
+        return major_class
+    return '*'
+
+
+_compression_stats = {}
+# entries are packaged by the worker pool threads.
+_compression_lock = Lock()
+
+
+def _record_compression(mime_class, zip_info, seconds):
+    with _compression_lock:
+        stats = _compression_stats.setdefault(
+            mime_class, {'entries': 0, 'size': 0, 'compressed_size': 0,
+                         'seconds': 0.0})
+        stats['entries'] += 1
+        stats['size'] += zip_info.file_size
+        stats['compressed_size'] += zip_info.compress_size
+        stats['seconds'] += seconds
+    logging.debug('packaged %s data: %d -> %d bytes in %.2fs', mime_class,
+                  zip_info.file_size, zip_info.compress_size, seconds)
+
+
+def get_compression_report():
+    """
+    Return the packaging statistics by mime class, to tune the compression
+    policy: entries, size, compressed_size, ratio (compressed size over
+    size) and seconds spent.
+    """
+    report = {}
+    with _compression_lock:
+        for mime_class, stats in _compression_stats.items():
+            report[mime_class] = dict(stats)
+    for stats in report.values():
+        stats['ratio'] = float(stats['compressed_size']) / (stats['size'] or 1)
+    return report
 
 
 def get_account():
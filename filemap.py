@@ -0,0 +1,108 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Read only mappings of files, shared by the users of the same file.
+
+A mapped file that is truncated while mapped kills the process with
+SIGBUS on the next read past its new end, and one that is rewritten in
+place changes under the reader.  So the file is never mapped itself:
+it is copied to a private temporary file, which is removed as soon as
+it is created, and the copy is mapped.  Nothing else can open the copy,
+and its disk space goes with the last mapping of it.
+
+    mappings = FileMappings(
+        lambda fd: mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+    key, data = mappings.map(path)
+    ...
+    mappings.unmap(key)
+'''
+
+import logging
+import os
+import shutil
+import tempfile
+
+
+def open_private_copy(path):
+    '''
+    Copy the file at path to a temporary file that has no name, and
+    return the copy open for reading.  The copy is made next to the file
+    if its directory is writable, so that it takes no memory on a tmpfs,
+    and in the temporary directory otherwise.
+    Raises: IOError or OSError, if the file cannot be read or the copy
+        cannot be written
+    '''
+    try:
+        fd, copy_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    except OSError:
+        fd, copy_path = tempfile.mkstemp()
+    os.remove(copy_path)
+    copy = os.fdopen(fd, 'w+b')
+    try:
+        with open(path, 'rb') as source:
+            shutil.copyfileobj(source, copy, 1 << 20)
+        copy.flush()
+        copy.seek(0)
+    except:
+        copy.close()
+        raise
+    return copy
+
+
+class FileMappings(object):
+    '''
+    Maps files with map_fd(fd), which returns the mapping of the open
+    file, and shares each mapping between the users of the same file.
+    A file that changed since it was mapped is mapped again; the users of
+    the old mapping keep it until they unmap it.
+    '''
+
+    def __init__(self, map_fd):
+        self._map_fd = map_fd
+        # (path, size, modification time) -> [mapping, number of users]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def map(self, path):
+        '''
+        Map the file at path.  Returns the key to pass to `unmap` when
+        done, and the mapping.
+        Raises: IOError or OSError, if the file cannot be copied
+        '''
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime)
+        entry = self._entries.get(key)
+        if entry is None:
+            logging.debug('mapping a copy of %s', path)
+            with open_private_copy(path) as copy:
+                # the mapping keeps the copy alive once the file is closed
+                entry = self._entries[key] = [self._map_fd(copy.fileno()), 0]
+        entry[1] += 1
+        return key, entry[0]
+
+    def get_users(self, key):
+        '''Return the number of users of the mapping with that key.'''
+        entry = self._entries.get(key)
+        return 0 if entry is None else entry[1]
+
+    def unmap(self, key):
+        entry = self._entries[key]
+        entry[1] -= 1
+        if not entry[1]:
+            # the mapping goes once the last reader of it lets go
+            del self._entries[key]
@@ -0,0 +1,356 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+A WebSocket client driven by the GLib main loop.  The socket is never
+blocked on: it is read and written from io watches, so a connection can
+live in the shell process without a helper thread and without stalling
+the Journal UI.
+
+    ws = WebSocketTransport()
+    ws.connect('open', lambda ws: ws.send('hello'))
+    ws.connect('message', lambda ws, opcode, data: ws.close())
+    ws.open('ws://127.0.0.1:8080/websocket')
+'''
+
+import errno
+import logging
+import socket
+import struct
+from collections import deque
+
+from gi.repository import GLib
+from gi.repository import GObject
+
+import websocket
+from websocket import ABNF, WebSocketException
+
+# number of bytes read from the socket at a time.
+READ_BLOCK_SIZE = 1 << 16
+# most bytes written from one main loop callback, so that a large send
+# does not hold up the UI until the socket buffer fills.
+WRITE_BUDGET = 1 << 18
+# seconds to wait for the server to answer a close frame.
+CLOSE_TIMEOUT = 3
+
+_CONNECTING = 0
+_HANDSHAKE = 1
+_OPEN = 2
+_CLOSING = 3
+_CLOSED = 4
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+
+class WebSocketTransport(GObject.GObject):
+    '''
+    Non-blocking WebSocket connection.  open() returns at once; 'open' is
+    emitted once the handshake is done, 'message' for every message
+    received, 'progress' as queued data is written to the socket and
+    'close' once, when the connection is closed for any reason.
+    Only ws:// urls are supported.
+    '''
+
+    __gsignals__ = {
+        'open': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+        'message': (GObject.SignalFlags.RUN_FIRST, None, ([int, object])),
+        'progress': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([object, object])),
+        'close': (GObject.SignalFlags.RUN_FIRST, None, ([int, str]))
+    }
+
+    def __init__(self, fragment_size=None):
+        GObject.GObject.__init__(self)
+        self.fragment_size = fragment_size
+        self._sock = None
+        self._state = _CLOSED
+        self._watches = {}
+        self._close_timeout = None
+        self._key = None
+        self._deflate = None
+        self._response = None
+        self._message = None
+        self._parser = None
+        self._fragments = []
+        self._close_status = None
+        # handshake response bytes not parsed yet.
+        self._in = bytearray()
+        # iterators of the byte strings still to write, and the one
+        # being written.
+        self._out = deque()
+        self._pending = None
+        self._pending_offset = 0
+        # bytes queued and bytes written, reported by 'progress'.
+        self.queued = 0
+        self.sent = 0
+
+    def open(self, url, **options):
+        '''
+        Start connecting to url.  options are the same as for
+        websocket.WebSocket.connect.  The host name is resolved before
+        this returns, so pass an address to avoid a DNS lookup.
+        '''
+        if self._state != _CLOSED:
+            raise WebSocketException('socket is already opened')
+        hostname, port, resource, is_secure = websocket._parse_url(url)
+        if is_secure:
+            raise WebSocketException('wss is not supported')
+
+        self._sock = socket.socket()
+        self._sock.setblocking(False)
+        self._state = _CONNECTING
+        self._in = bytearray()
+        self._out.clear()
+        self._pending = None
+        self._response = websocket._HandshakeResponse()
+        self._key, self._deflate, header_str = \
+            websocket._get_handshake_request(hostname, port, resource,
+                                             **options)
+        self._queue([header_str])
+        error = self._sock.connect_ex((hostname, port))
+        if error and error not in _WOULD_BLOCK:
+            self._abort(socket.error(error, 'connect failed'))
+            return
+        self._watch(GLib.IO_IN)
+        self._watch(GLib.IO_OUT)
+
+    def send(self, payload, opcode=ABNF.OPCODE_TEXT):
+        '''
+        Queue a message.  It is written as the socket becomes writable.
+        '''
+        self._check_open()
+        self._queue([websocket._format_frame(frame, None) for frame in
+                     websocket._create_message_frames(
+                         payload, opcode, self.fragment_size, self._deflate)])
+
+    def send_stream(self, source, opcode=ABNF.OPCODE_BINARY, length=None,
+                    chunk_size=websocket.STREAM_CHUNK_SIZE):
+        '''
+        Queue the data of a file-like object or a buffer as one message.
+        It is only read chunk_size bytes at a time, as the socket drains,
+        so the file must stay open until 'progress' reports it sent.
+        '''
+        self._check_open()
+        if length is None:
+            if isinstance(source, (str, bytearray, memoryview, buffer)):
+                length = len(source)
+            else:
+                length = websocket._remaining_length(source)
+        chunks = websocket._iter_stream(source, opcode, length, chunk_size,
+                                        None, self._deflate)
+        if self._deflate is None or not self._deflate.compressing:
+            header = ABNF(1, 0, 0, 0, opcode, 1).format_header(length)
+            self.queued += len(header) + 4 + length
+        else:
+            # the compressed size is only known as it is produced.
+            chunks = self._count(chunks)
+        self._queue(chunks, count=False)
+
+    def close(self, status=websocket.STATUS_NORMAL, reason=''):
+        '''
+        Start the closing handshake.  'close' is emitted when the server
+        answers, or after CLOSE_TIMEOUT seconds.
+        '''
+        if self._state in (_CONNECTING, _HANDSHAKE):
+            self._finish(websocket.STATUS_GOING_AWAY, reason)
+        elif self._state == _OPEN:
+            self._send_close(status, reason)
+            self._close_timeout = GLib.timeout_add_seconds(
+                CLOSE_TIMEOUT, self.__close_timeout_cb)
+
+    def is_open(self):
+        return self._state == _OPEN
+
+    def _check_open(self):
+        if self._state != _OPEN:
+            raise WebSocketException('connection is not open')
+
+    def _send_close(self, status, reason):
+        self._queue([websocket._format_frame(
+            ABNF.create_frame(struct.pack('!H', status) + reason,
+                              ABNF.OPCODE_CLOSE), None)])
+        self._state = _CLOSING
+
+    def _queue(self, chunks, count=True):
+        if count:
+            chunks = list(chunks)
+            self.queued += sum(len(chunk) for chunk in chunks)
+        self._out.append(iter(chunks))
+        if self._state != _CONNECTING:
+            self._watch(GLib.IO_OUT)
+
+    def _count(self, chunks):
+        for chunk in chunks:
+            self.queued += len(chunk)
+            yield chunk
+
+    def _watch(self, condition):
+        if condition not in self._watches:
+            self._watches[condition] = GLib.io_add_watch(
+                self._sock.fileno(), GLib.PRIORITY_DEFAULT,
+                condition | GLib.IO_HUP | GLib.IO_ERR, self.__io_cb,
+                condition)
+
+    def __io_cb(self, fd, condition, watched):
+        if self._sock is None:
+            return False
+        try:
+            if watched == GLib.IO_OUT:
+                keep = self._write()
+            else:
+                keep = self._read()
+        except (socket.error, WebSocketException), e:
+            self._abort(e)
+            return False
+        if self._sock is None:
+            return False
+        if not keep:
+            self._watches.pop(watched, None)
+        return keep
+
+    def _write(self):
+        if self._state == _CONNECTING:
+            error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, 'connect failed')
+            self._state = _HANDSHAKE
+
+        written = 0
+        while written < WRITE_BUDGET:
+            if self._pending is None:
+                if not self._out:
+                    break
+                chunk = next(self._out[0], None)
+                if chunk is None:
+                    self._out.popleft()
+                    continue
+                self._pending = chunk
+                self._pending_offset = 0
+            try:
+                n = self._sock.send(buffer(self._pending,
+                                           self._pending_offset))
+            except socket.error, e:
+                if e.errno in _WOULD_BLOCK:
+                    break
+                raise
+            written += n
+            self._pending_offset += n
+            if self._pending_offset == len(self._pending):
+                self._pending = None
+
+        if written:
+            self.sent += written
+            self.emit('progress', self.sent, self.queued)
+        if self._pending is not None or self._out:
+            return True
+        if self._state == _CLOSED:
+            self._finish(*self._close_status)
+        return False
+
+    def _read(self):
+        try:
+            data = self._sock.recv(READ_BLOCK_SIZE)
+        except socket.error, e:
+            if e.errno in _WOULD_BLOCK:
+                return True
+            raise
+        if not data:
+            raise WebSocketException('connection is already closed.')
+
+        if self._state == _HANDSHAKE:
+            self._in += data
+            data = self._read_handshake()
+        if data and self._state in (_OPEN, _CLOSING):
+            self._read_frames(self._parser.feed(data))
+        return self._sock is not None and self._state != _CLOSED
+
+    def _read_handshake(self):
+        while True:
+            end = self._in.find('\n')
+            if end < 0:
+                return None
+            line = str(self._in[:end + 1])
+            del self._in[:end + 1]
+            if self._response.feed_line(line):
+                break
+        self._deflate = websocket._check_handshake_response(
+            self._response.status, self._response.headers, self._key,
+            self._deflate)
+        self._message = websocket._MessageReader(self._deflate)
+        self._parser = websocket.ABNFParser()
+        self._fragments = []
+        self._state = _OPEN
+        self.emit('open')
+        # the frames that arrived with the end of the handshake.
+        data = str(self._in)
+        self._in = bytearray()
+        return data
+
+    def _read_frames(self, frames):
+        for frame in frames:
+            if self._state not in (_OPEN, _CLOSING):
+                return
+            if frame.opcode == ABNF.OPCODE_CLOSE:
+                self._on_close_frame(frame)
+            elif frame.opcode == ABNF.OPCODE_PING:
+                self._queue([websocket._format_frame(
+                    ABNF.create_frame(str(frame.data), ABNF.OPCODE_PONG),
+                    None)])
+            elif frame.opcode != ABNF.OPCODE_PONG:
+                opcode, data, fin = self._message.feed(frame)
+                self._fragments.append(str(data))
+                if fin:
+                    data = ''.join(self._fragments)
+                    self._fragments = []
+                    self.emit('message', opcode, data)
+
+    def _on_close_frame(self, frame):
+        status = websocket.STATUS_STATUS_NOT_AVAILABLE
+        reason = ''
+        if len(frame.data) >= 2:
+            status = struct.unpack('!H', str(frame.data[:2]))[0]
+            reason = str(frame.data[2:])
+        if self._state == _OPEN:
+            # answer, and close once the answer is written.
+            self._send_close(status, '')
+            self._close_status = (status, reason)
+            self._state = _CLOSED
+        else:
+            self._finish(status, reason)
+
+    def __close_timeout_cb(self):
+        self._close_timeout = None
+        self._finish(websocket.STATUS_ABNORMAL_CLOSED, 'close timed out')
+        return False
+
+    def _abort(self, error):
+        logging.debug('websocket connection failed: %s', error)
+        self._finish(websocket.STATUS_ABNORMAL_CLOSED, str(error))
+
+    def _finish(self, status, reason):
+        if self._sock is None:
+            return
+        for source_id in self._watches.values():
+            GLib.source_remove(source_id)
+        self._watches = {}
+        if self._close_timeout is not None:
+            GLib.source_remove(self._close_timeout)
+            self._close_timeout = None
+        self._sock.close()
+        self._sock = None
+        self._state = _CLOSED
+        self._out.clear()
+        self._pending = None
+        self.emit('close', status, reason)
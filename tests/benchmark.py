@@ -0,0 +1,404 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Microbenchmarks.  Run from the top directory, naming the ones to run,
+or none to run them all:
+
+    python tests/benchmark.py [clients] [codec] [mask] [package] [parser]
+                              [recv] [stall]
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import websocket
+from websocket import ABNF
+
+from test_websocket import mask_bytewise, server_frame
+from wsserver import EchoServer
+
+if websocket.asyncio is not None:
+    from trollius import From
+
+# the byte at a time masking is only timed up to this size, it takes
+# minutes beyond.
+BYTEWISE_MAX = 4 << 20
+# size of the data file of the journal entry packaged.
+PACKAGE_SIZE = 200 << 20
+# milliseconds between the ticks that time the main loop.
+TICK_INTERVAL = 10
+CLIENTS = 100
+# what every client sends and receives back.
+CLIENT_MESSAGES = [(ABNF.OPCODE_TEXT, 'message %d' % i) for i in range(5)] + \
+    [(ABNF.OPCODE_BINARY, 'x' * (300 * 1024))]
+
+
+def _rate(func, size, min_seconds=0.5):
+    count = 0
+    start = time.time()
+    while True:
+        func()
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= min_seconds:
+            return count / elapsed, size * count / elapsed / 1e6
+
+
+def _echo_blocking(url):
+    ws = websocket.create_connection(url)
+    for opcode, data in CLIENT_MESSAGES:
+        ws.send(data, opcode)
+        assert ws.recv_data() == (opcode, data)
+    ws.close()
+
+
+def _echo_async(url, loop):
+    ws = yield From(websocket.create_async_connection(url, loop=loop))
+    for opcode, data in CLIENT_MESSAGES:
+        yield From(ws.send(data, opcode))
+        received = yield From(ws.recv_data())
+        assert received == (opcode, data)
+    yield From(ws.close())
+
+
+def bench_clients():
+    '''
+    Seconds for 100 clients to send 5 text messages and a 300 KB binary
+    one each to a local echo server, and get them back: blocking clients
+    on a thread each, and AsyncWebSocket clients sharing one event loop.
+    The server runs a thread per connection in the same process.
+    '''
+    print '%d clients echoing messages, seconds' % CLIENTS
+    server = EchoServer()
+    try:
+        threads = [threading.Thread(target=_echo_blocking,
+                                    args=(server.url,))
+                   for i in range(CLIENTS)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print '%12s %.2f' % ('threads', time.time() - start)
+
+        if websocket.asyncio is None:
+            print '%12s -' % 'trollius'
+            return
+        loop = websocket.asyncio.new_event_loop()
+        echo = websocket.asyncio.coroutine(_echo_async)
+        start = time.time()
+        loop.run_until_complete(websocket.asyncio.gather(
+            *[echo(server.url, loop) for i in range(CLIENTS)], loop=loop))
+        print '%12s %.2f' % ('trollius', time.time() - start)
+        loop.close()
+    finally:
+        server.close()
+
+
+def bench_codec():
+    '''
+    Messages per second encoded and decoded, and text bytes per message,
+    for the upload events and a batch of 20 of them, with the json codec
+    and the compact one the uploader offers.
+    '''
+    try:
+        import textchannelwrapper
+    except ImportError:
+        print 'codecs: the Sugar toolkit modules are not installed'
+        return
+    schemas = [('j', ['nick']), ('c', ['nick', 'mode'])]
+    events = [{'cmd': 'j', 'nick': 'Walter Bender'},
+              {'cmd': 'c', 'nick': 'Walter Bender', 'mode': 'binary'}]
+    print 'codecs, messages/s and bytes/message'
+    print '%10s %8s %12s %12s %8s' % ('codec', 'messages', 'encode',
+                                      'decode', 'bytes')
+    for codec in (textchannelwrapper.JsonCodec(),
+                  textchannelwrapper.CompactCodec(schemas)):
+        for count in (1, 20):
+            messages = (events * count)[:count]
+
+            def encode():
+                return codec.join([codec.encode(msg) for msg in messages])
+
+            text = encode()
+            assert codec.decode(text) == messages
+            encoded = _rate(encode, 1)[0] * count
+            decoded = _rate(lambda: codec.decode(text), 1)[0] * count
+            print '%10s %8d %12d %12d %8.1f' % (
+                codec.name[:10], count, encoded, decoded,
+                len(text) / float(count))
+
+
+def bench_mask():
+    print 'masking, MB/s'
+    print '%10s %10s %10s %10s' % ('size', 'bytewise', 'long', 'numpy')
+    mask_key = os.urandom(4)
+    size = 1 << 10
+    while size <= 64 << 20:
+        data = os.urandom(size)
+        row = []
+        for mask in (mask_bytewise, websocket._mask_long,
+                     websocket._mask_numpy):
+            if mask is mask_bytewise and size > BYTEWISE_MAX or \
+                    mask is websocket._mask_numpy and \
+                    websocket.numpy is None:
+                row.append('-')
+                continue
+            row.append('%.1f' % _rate(lambda: mask(mask_key, data), size)[1])
+        print '%10d %10s %10s %10s' % ((size,) + tuple(row))
+        size <<= 2
+
+
+def _recv_frames(stream):
+    # WebSocket.recv_frame reading from a socket that holds the stream.
+    class Socket(object):
+        def __init__(self):
+            self.offset = 0
+
+        def recv(self, size):
+            data = stream[self.offset:self.offset + size]
+            self.offset += len(data)
+            return data
+
+        def recv_into(self, view, size):
+            data = self.recv(size)
+            view[:len(data)] = data
+            return len(data)
+
+    ws = websocket.WebSocket()
+    ws.io_sock = Socket()
+    while ws.io_sock.offset < len(stream):
+        ws.recv_frame()
+
+
+def bench_parser():
+    print 'frame parsing, frames/s'
+    print '%10s %10s %12s %12s' % ('payload', 'pieces', 'ABNFParser',
+                                   'recv_frame')
+    for size in (16, 1024, 65536):
+        count = max(1, (1 << 20) // size)
+        stream = server_frame(ABNF.OPCODE_BINARY, 'x' * size) * count
+        for piece_size in (1460, 1 << 16):
+            pieces = [stream[offset:offset + piece_size]
+                      for offset in xrange(0, len(stream), piece_size)]
+
+            def parse():
+                parser = websocket.ABNFParser()
+                for piece in pieces:
+                    parser.feed(piece)
+
+            parsed = _rate(parse, 1)[0] * count
+            received = _rate(lambda: _recv_frames(stream), 1)[0] * count
+            print '%10d %10d %12d %12d' % (size, piece_size, parsed,
+                                           received)
+
+
+class _SegmentSocket(object):
+    '''A socket that holds stream and returns it segment_size at a time.'''
+
+    def __init__(self, stream, segment_size):
+        self._stream = memoryview(stream)
+        self._segment_size = segment_size
+        self.offset = 0
+
+    def _next(self, size):
+        size = min(size, self._segment_size, len(self._stream) - self.offset)
+        self.offset += size
+        return self._stream[self.offset - size:self.offset]
+
+    def recv(self, size):
+        return self._next(size).tobytes()
+
+    def recv_into(self, view, size):
+        # copied straight into the buffer, like a real socket.
+        data = self._next(size)
+        view[:len(data)] = data
+        return len(data)
+
+
+def _recv_strict_concat(sock, bufsize):
+    # the _recv_strict the preallocated buffer replaced.
+    remaining = bufsize
+    bytes = ""
+    while remaining:
+        bytes += sock.recv(remaining)
+        remaining = bufsize - len(bytes)
+    return bytes
+
+
+def bench_recv():
+    '''
+    Seconds to receive one 32 MB frame arriving in 1 KB segments, with the
+    old string concatenation and with recv_frame.
+    '''
+    print 'receiving a 32 MB frame in 1 KB segments, seconds'
+    payload = 'x' * (32 << 20)
+    stream = server_frame(ABNF.OPCODE_BINARY, payload)
+    header_size = len(stream) - len(payload)
+
+    sock = _SegmentSocket(stream, 1024)
+    start = time.time()
+    sock.recv(header_size)
+    data = _recv_strict_concat(sock, len(payload))
+    print '%12s %.2f' % ('concatenate', time.time() - start)
+    assert len(data) == len(payload)
+    del data
+
+    ws = websocket.WebSocket()
+    ws.io_sock = _SegmentSocket(stream, 1024)
+    start = time.time()
+    frame = ws.recv_frame()
+    print '%12s %.2f' % ('recv_frame', time.time() - start)
+    assert len(frame.data) == len(payload)
+
+
+class _DSObject(object):
+    '''A journal entry, as write_ds_object reads it.'''
+
+    def __init__(self, file_path, metadata):
+        self.object_id = 'benchmark'
+        self.file_path = file_path
+        self.metadata = metadata
+
+
+def _write_data(path):
+    data_path = os.path.join(path, 'data')
+    with open(data_path, 'wb') as data_file:
+        for i in xrange(PACKAGE_SIZE >> 20):
+            data_file.write(os.urandom(1 << 20))
+    return data_path
+
+
+def _get_status_kb(name):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(name + ':'):
+                return int(line.split()[1])
+
+
+def bench_package():
+    '''
+    Seconds and peak resident memory to package a 200 MB journal entry
+    with write_ds_object, stored and deflated.  Each one runs in a child
+    process, so that the peak is its own; the growth is above the
+    resident size the child started with.
+    '''
+    try:
+        import account
+    except ImportError:
+        print 'packaging: the Sugar shell modules are not installed'
+        return
+    print 'packaging a %d MB entry' % (PACKAGE_SIZE >> 20)
+    print '%12s %10s %14s %14s' % ('mime type', 'seconds', 'peak RSS, MB',
+                                   'growth, MB')
+    path = tempfile.mkdtemp()
+    try:
+        data_path = _write_data(path)
+        for mime_type in ('video/ogg', 'text/plain'):
+            dsobj = _DSObject(data_path, {'mime_type': mime_type,
+                                          'title': 'benchmark'})
+            pid = os.fork()
+            if pid:
+                os.waitpid(pid, 0)
+                continue
+            rss = _get_status_kb('VmRSS')
+            start = time.time()
+            with open(os.path.join(path, 'package'), 'wb') as package:
+                account.write_ds_object(dsobj, package)
+            seconds = time.time() - start
+            peak = _get_status_kb('VmHWM')
+            print '%12s %10.2f %14.1f %14.1f' % (mime_type, seconds,
+                                                 peak / 1024.0,
+                                                 (peak - rss) / 1024.0)
+            sys.stdout.flush()
+            os._exit(0)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_stall():
+    '''
+    Longest the main loop goes without running while a 200 MB journal
+    entry is packaged and hashed for a share: in an idle callback, as the
+    share did before the worker pool, and on the worker pool.  A tick
+    every 10 ms takes the time between its runs.
+    '''
+    try:
+        from gi.repository import GLib
+        import account
+    except ImportError:
+        print 'main loop stall: the Sugar shell modules are not installed'
+        return
+    print 'longest main loop stall preparing a %d MB entry, seconds' % (
+        PACKAGE_SIZE >> 20)
+    path = tempfile.mkdtemp()
+    try:
+        dsobj = _DSObject(_write_data(path), {'mime_type': 'video/ogg',
+                                              'title': 'benchmark'})
+        pool = account.WorkerPool(account.WORKER_THREADS)
+        for name in ('main loop', 'worker pool'):
+            cache = account.PackageCache(os.path.join(path, name),
+                                         PACKAGE_SIZE * 2)
+            loop = GLib.MainLoop()
+            # longest time between ticks, time of the last tick, done.
+            state = [0.0, time.time(), False]
+
+            def tick_cb():
+                now = time.time()
+                state[0] = max(state[0], now - state[1])
+                state[1] = now
+                if state[2]:
+                    # the tick after the share is prepared.
+                    loop.quit()
+                    return False
+                return True
+
+            def prepared_cb(job, result):
+                state[2] = True
+
+            def prepare_cb():
+                job = account._Job(None, (), None, None, None, None)
+                account.prepare_upload(job, cache, dsobj)
+                state[2] = True
+                return False
+
+            if name == 'main loop':
+                GLib.idle_add(prepare_cb)
+            else:
+                pool.submit(account.prepare_upload, cache, dsobj,
+                            result_cb=prepared_cb)
+            GLib.timeout_add(TICK_INTERVAL, tick_cb)
+            loop.run()
+            print '%12s %.3f' % (name, state[0])
+    finally:
+        shutil.rmtree(path)
+
+
+BENCHMARKS = {'clients': bench_clients, 'codec': bench_codec,
+              'mask': bench_mask, 'package': bench_package,
+              'parser': bench_parser, 'recv': bench_recv,
+              'stall': bench_stall}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
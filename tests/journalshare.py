@@ -0,0 +1,127 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+A stand-in JournalShare upload server on a local port, for the tests
+and benchmarks of the uploads.
+'''
+
+import base64
+import json
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import websocket
+
+from wsserver import WebSocketServer
+
+
+class JournalShareServer(WebSocketServer):
+    '''
+    Accepts uploads, like the JournalShare activity.
+
+    mode: upload mode answered to the join, or None for a server that
+          never answers it, like the old ones that only take base64 text.
+    chunked: answer the join with the offset already received of the
+             content, and acknowledge every chunk.
+    drop_after: close a connection after that many chunks, drops times.
+    stall_after: ignore the chunks of a connection after that many, once,
+                 leaving it open without acknowledging them.
+    '''
+
+    path = '/websocket/upload'
+
+    def __init__(self, mode='binary', chunked=False, drop_after=None,
+                 drops=1, stall_after=None):
+        self.mode = mode
+        self.chunked = chunked
+        self.drop_after = drop_after
+        self.drops = drops
+        self.stall_after = stall_after
+        # content hash -> data received.
+        self.data = {}
+        self.joins = []
+        # offsets the chunked uploads were resumed from.
+        self.offsets = []
+        # bytes received of the content when the connections were dropped.
+        self.dropped_at = []
+        self.chunks = 0
+        self.chunk_bytes = 0
+        # payload bytes of the messages received.
+        self.wire_bytes = 0
+        WebSocketServer.__init__(self)
+
+    def serve_connection(self, ws):
+        ws.content_hash = None
+        # chunks received on the connection, None once it stalls.
+        ws.chunks = 0
+
+    def serve_message(self, ws, opcode, data):
+        with self._lock:
+            self.wire_bytes += len(data)
+        if opcode == websocket.ABNF.OPCODE_BINARY:
+            if self.chunked:
+                offset = struct.unpack('!Q', data[:8])[0]
+                self._chunk(ws, offset, data[8:])
+            else:
+                self.data[ws.content_hash] += data
+            return
+        if not data.startswith('{'):
+            self.data[ws.content_hash] += base64.b64decode(data)
+            return
+        msg = json.loads(data)
+        if msg['cmd'] == 'j':
+            ws.content_hash = msg['hash']
+            self._join(ws, msg)
+        elif msg['cmd'] == 'k':
+            self._chunk(ws, msg['offset'], base64.b64decode(msg['data']))
+
+    def _join(self, ws, msg):
+        self.joins.append(msg)
+        if not self.chunked:
+            # a streamed upload always starts from the beginning.
+            self.data[msg['hash']] = bytearray()
+        data = self.data.setdefault(msg['hash'], bytearray())
+        if self.mode is None:
+            return
+        reply = {'cmd': 'j', 'mode': self.mode}
+        if self.chunked:
+            reply['offset'] = len(data)
+            self.offsets.append(len(data))
+        ws.send(json.dumps(reply))
+
+    def _chunk(self, ws, offset, chunk):
+        if ws.chunks is None:
+            return
+        if ws.chunks == self.stall_after:
+            self.stall_after = None
+            ws.chunks = None
+            return
+        data = self.data[ws.content_hash]
+        if offset != len(data):
+            raise websocket.WebSocketException(
+                'chunk at %d, expected %d' % (offset, len(data)))
+        data += chunk
+        self.chunks += 1
+        self.chunk_bytes += len(chunk)
+        ws.chunks += 1
+        if ws.chunks == self.drop_after and self.drops:
+            self.drops -= 1
+            self.dropped_at.append(len(data))
+            raise websocket.WebSocketException('dropped')
+        ws.send(json.dumps({'cmd': 'a', 'offset': len(data)}))
@@ -0,0 +1,300 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Tests of the uploads to a stand-in JournalShare server.  They need the
+modules of the Sugar shell, and are skipped without them.
+'''
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from journalshare import JournalShareServer
+
+try:
+    import account
+except ImportError:
+    account = None
+
+PACKAGE_SIZE = 2 * 1024 * 1024
+
+
+class _DSObject(object):
+
+    def __init__(self, file_path, metadata):
+        self.object_id = 'test'
+        self.file_path = file_path
+        self.metadata = metadata
+
+
+class _Collab(object):
+    '''The collaboration of the uploader, which the tests do not need.'''
+
+    def __init__(self, activity, codec=None):
+        self.message = self
+        self.posted = []
+
+    def connect(self, callback):
+        pass
+
+    def setup(self):
+        pass
+
+    def post(self, msg):
+        self.posted.append(msg)
+
+
+@unittest.skipIf(account is None, 'the Sugar shell modules are not installed')
+class UploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self._collab_wrapper = account.CollabWrapper
+        account.CollabWrapper = _Collab
+        self._constants = dict((name, getattr(account, name)) for name in
+                               ('ACK_TIMEOUT', 'MAX_CHUNK_SIZE',
+                                'RETRY_DELAY'))
+        account.RETRY_DELAY = 0
+        self.path = tempfile.mkdtemp()
+        self.package = os.path.join(self.path, 'package.zip')
+        with zipfile.ZipFile(self.package, 'w') as package:
+            package.writestr('data', os.urandom(PACKAGE_SIZE))
+        self.servers = []
+
+    def tearDown(self):
+        account.CollabWrapper = self._collab_wrapper
+        for name, value in self._constants.items():
+            setattr(account, name, value)
+        account._silent_servers.clear()
+        for server in self.servers:
+            server.close()
+        shutil.rmtree(self.path)
+
+    def _server(self, *args, **kwargs):
+        self.servers.append(JournalShareServer(*args, **kwargs))
+        return self.servers[-1]
+
+    def _upload(self, server, retry=False, **kwargs):
+        uploader = account.Uploader(self.package, server.url, **kwargs)
+        start = time.time()
+        if retry:
+            uploader._upload()
+            # the uploaded signal is emitted from the main loop.
+            self.assertEqual(uploader._pending, [])
+        else:
+            uploader._upload_once()
+        seconds = time.time() - start
+        self.assertEqual(str(server.data[uploader.content_hash]),
+                         open(self.package, 'rb').read())
+        return uploader, seconds
+
+    def test_binary_is_faster_than_base64(self):
+        rates = {}
+        wire_bytes = {}
+        for mode in account.UPLOAD_MODES:
+            best = None
+            for i in range(3):
+                server = self._server(mode)
+                uploader, seconds = self._upload(server)
+                self.assertEqual(uploader.mode, mode)
+                best = min(best or seconds, seconds)
+            rates[mode] = PACKAGE_SIZE / best
+            wire_bytes[mode] = server.wire_bytes
+        # base64 sends 4 characters for every 3 bytes.
+        self.assertTrue(wire_bytes[account.BASE64_MODE] >
+                        wire_bytes[account.BINARY_MODE] * 1.3)
+        self.assertTrue(rates[account.BINARY_MODE] >
+                        rates[account.BASE64_MODE],
+                        'binary %d B/s, base64 %d B/s' %
+                        (rates[account.BINARY_MODE],
+                         rates[account.BASE64_MODE]))
+
+    def test_silent_server_is_waited_for_once(self):
+        server = self._server(None)
+        uploader, seconds = self._upload(server)
+        self.assertEqual(uploader.mode, account.BASE64_MODE)
+        self.assertTrue(seconds >= account.NEGOTIATE_TIMEOUT)
+        uploader, seconds = self._upload(server)
+        self.assertEqual(uploader.mode, account.BASE64_MODE)
+        self.assertTrue(seconds < account.NEGOTIATE_TIMEOUT)
+
+    def test_stalled_upload_resumes(self):
+        account.ACK_TIMEOUT = 0.5
+        server = self._server(chunked=True, stall_after=3)
+        uploader, seconds = self._upload(server, retry=True)
+        self.assertEqual(server.connections, 2)
+        # the chunks sent after the stall are sent again.
+        self.assertEqual(server.offsets[0], 0)
+        self.assertTrue(server.offsets[1] > 0)
+
+    def test_dropped_upload_resumes(self):
+        for mode in account.UPLOAD_MODES:
+            server = self._server(mode, chunked=True, drop_after=5)
+            uploader, seconds = self._upload(server, retry=True)
+            self.assertEqual(uploader.mode, mode)
+            self.assertEqual(server.connections, 2)
+            # the second connection starts where the server got to, and
+            # no chunk is sent twice.
+            self.assertEqual(len(server.dropped_at), 1)
+            self.assertTrue(server.dropped_at[0] > 0)
+            self.assertEqual(server.offsets, [0, server.dropped_at[0]])
+            self.assertEqual(server.chunk_bytes,
+                             os.path.getsize(self.package))
+
+    def test_retries_are_counted_without_progress(self):
+        # the upload is dropped more often than it is retried, but every
+        # connection acknowledges some more of it.
+        account.MAX_CHUNK_SIZE = account.CHUNK_SIZE
+        server = self._server(chunked=True, drop_after=100,
+                              drops=account.UPLOAD_RETRIES + 3)
+        uploader, seconds = self._upload(server, retry=True)
+        self.assertEqual(server.connections, account.UPLOAD_RETRIES + 4)
+
+
+@unittest.skipIf(account is None, 'the Sugar shell modules are not installed')
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = JournalShareServer()
+        self.pool = account.ConnectionPool(60)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_idle_connection_is_pinged_and_reused(self):
+        ws = self.pool.acquire(self.server.url)
+        self.pool.release(self.server.url, ws)
+        self.pool._check_idle()
+        self.assertEqual(self.pool._idle[self.server.url][0][0], ws)
+        self.assertTrue(ws.connected)
+        self.assertTrue(self.pool.acquire(self.server.url) is ws)
+        self.assertEqual(self.server.connections, 1)
+        stats = self.pool.get_stats()
+        self.assertEqual((stats['handshakes'], stats['reuses']), (1, 1))
+
+    def test_expired_connection_is_closed(self):
+        ws = self.pool.acquire(self.server.url)
+        self.pool.release(self.server.url, ws)
+        self.pool.max_idle = 0
+        time.sleep(0.01)
+        self.pool._check_idle()
+        self.assertEqual(self.pool._idle, {})
+        self.assertFalse(ws.connected)
+        # the timer stops once there is nothing left to check.
+        self.assertFalse(self.pool._ConnectionPool__check_cb())
+        self.assertTrue(self.pool._check_id is None)
+
+    def test_dead_connection_is_closed(self):
+        ws = self.pool.acquire(self.server.url)
+        self.pool.release(self.server.url, ws)
+        ws.sock.shutdown(socket.SHUT_RDWR)
+        self.pool._check_idle()
+        self.assertEqual(self.pool._idle, {})
+
+    def test_counters_from_threads(self):
+        def use():
+            for i in range(5):
+                ws = self.pool.acquire(self.server.url)
+                self.pool.release(self.server.url, ws)
+
+        threads = [threading.Thread(target=use) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['handshakes'] + stats['reuses'], 20)
+        self.assertEqual(stats['handshakes'], self.server.connections)
+
+
+@unittest.skipIf(account is None, 'the Sugar shell modules are not installed')
+class PackageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.path, 'data')
+        with open(self.data_path, 'wb') as data_file:
+            data_file.write('journal entry' * 1000)
+        self.cache = account.PackageCache(os.path.join(self.path, 'cache'),
+                                          1 << 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_sharing_again_adds_a_comment_and_hits_the_cache(self):
+        dsobj = _DSObject(self.data_path, {'mime_type': 'text/plain',
+                                           'title': 'entry'})
+        user_data = {'from': 'kid', 'icon': ['#FFC169', '#FF2B34']}
+        file_paths = []
+        for i in range(2):
+            account._add_share_comment(dsobj, user_data)
+            file_paths.append(self.cache.get_package(dsobj))
+            self.cache.release(file_paths[-1])
+        self.assertEqual(len(json.loads(dsobj.metadata['comments'])), 2)
+        self.assertEqual(file_paths[0], file_paths[1])
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+    def test_metadata_changes_the_key(self):
+        dsobj = _DSObject(self.data_path, {'title': 'entry'})
+        file_path = self.cache.get_package(dsobj)
+        dsobj.metadata['title'] = 'renamed'
+        self.assertNotEqual(self.cache.get_package(dsobj), file_path)
+
+    def test_failed_package_is_removed(self):
+        # a preview that is not base64 cannot be packaged.
+        dsobj = _DSObject(self.data_path, {'preview': 'not base64!'})
+        self.assertRaises(TypeError, self.cache.get_package, dsobj)
+        self.assertEqual(os.listdir(os.path.join(self.path, 'cache')), [])
+        self.assertEqual(self.cache.get_stats()['entries'], 0)
+
+
+@unittest.skipIf(account is None, 'the Sugar shell modules are not installed')
+class WorkerPoolTest(unittest.TestCase):
+
+    def test_full_queue_refuses_jobs(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def block(job):
+            started.set()
+            finish.wait()
+
+        pool = account.WorkerPool(1, max_queued=2)
+        pool.submit(block)
+        started.wait()
+        jobs = [pool.submit(block) for i in range(2)]
+        self.assertRaises(account.WorkerPoolFull, pool.submit, block)
+        # cancelled jobs leave the queue once a thread gets to them.
+        for job in jobs:
+            job.cancel()
+        finish.set()
+        for i in range(100):
+            if pool._queue.empty():
+                break
+            time.sleep(0.01)
+        pool.submit(block)
+
+
+if __name__ == '__main__':
+    unittest.main()
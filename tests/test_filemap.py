@@ -0,0 +1,183 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Tests of the shared file mappings, with the mmap module standing in for
+the GLib mappings of the collaboration wrapper.
+'''
+
+import mmap
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from filemap import FileMappings
+
+# size of the file sent to the receivers.
+BIG_FILE_SIZE = 500 * 1024 * 1024
+RECEIVERS = 4
+# anonymous memory the transfers may add, in kB.
+RSS_SLACK = 32 * 1024
+
+
+def _get_anonymous_rss():
+    # kB of anonymous memory, the mapped file pages are not counted.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _map_fd(fd):
+    return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+
+class _Sender(threading.Thread):
+    '''Sends a mapping over a socket a piece at a time, like a splice.'''
+
+    def __init__(self, sock, data):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._sock = sock
+        self._data = data
+
+    def run(self):
+        offset = 0
+        while offset < len(self._data):
+            offset += self._sock.send(buffer(self._data, offset, 1 << 16))
+        self._sock.close()
+
+
+class _Receiver(threading.Thread):
+    '''Reads a socket to the end, keeping only the byte count.'''
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._sock = sock
+        self.received = 0
+
+    def run(self):
+        while True:
+            data = self._sock.recv(1 << 16)
+            if not data:
+                break
+            self.received += len(data)
+        self._sock.close()
+
+
+class FileMappingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'entry')
+        with open(self.path, 'wb') as entry:
+            entry.write('journal entry' * 1000)
+        self.mappings = FileMappings(_map_fd)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_users_share_one_mapping(self):
+        key, data = self.mappings.map(self.path)
+        other_key, other_data = self.mappings.map(self.path)
+        self.assertEqual(key, other_key)
+        self.assertTrue(data is other_data)
+        self.assertEqual(len(self.mappings), 1)
+        self.assertEqual(self.mappings.get_users(key), 2)
+        self.assertEqual(data[:], open(self.path, 'rb').read())
+
+        self.mappings.unmap(key)
+        self.assertEqual(self.mappings.get_users(key), 1)
+        self.mappings.unmap(other_key)
+        self.assertEqual(len(self.mappings), 0)
+
+    def test_changed_file_is_mapped_again(self):
+        key, data = self.mappings.map(self.path)
+        with open(self.path, 'a') as changed:
+            changed.write('more')
+        os.utime(self.path, (0, 0))
+        other_key, other_data = self.mappings.map(self.path)
+        self.assertNotEqual(key, other_key)
+        self.assertEqual(len(other_data), len(data) + 4)
+        self.mappings.unmap(key)
+        self.mappings.unmap(other_key)
+        self.assertEqual(len(self.mappings), 0)
+
+    def test_truncated_file_leaves_the_mapping(self):
+        expected = open(self.path, 'rb').read()
+        key, data = self.mappings.map(self.path)
+        # reading past the end of a truncated mapped file is a SIGBUS.
+        open(self.path, 'wb').close()
+        self.assertEqual(data[:], expected)
+        self.mappings.unmap(key)
+
+    def test_copy_has_no_name(self):
+        key, data = self.mappings.map(self.path)
+        self.assertEqual(os.listdir(self.dir), ['entry'])
+        self.mappings.unmap(key)
+
+    def test_missing_file_is_not_mapped(self):
+        os.remove(self.path)
+        self.assertRaises(OSError, self.mappings.map, self.path)
+        self.assertEqual(len(self.mappings), 0)
+
+    @unittest.skipIf(_get_anonymous_rss() is None, 'RssAnon is not reported')
+    def test_big_file_to_several_receivers(self):
+        st = os.statvfs(self.dir)
+        if st.f_bavail * st.f_frsize < 2 * BIG_FILE_SIZE:
+            self.skipTest('no disk space for the file and its copy')
+        # a sparse file; the copy takes the disk space.
+        with open(self.path, 'wb') as big_file:
+            big_file.truncate(BIG_FILE_SIZE)
+        rss = _get_anonymous_rss()
+        threads = []
+        keys = []
+        for i in range(RECEIVERS):
+            key, data = self.mappings.map(self.path)
+            keys.append(key)
+            sender, receiver = socket.socketpair()
+            threads.append(_Receiver(receiver))
+            threads.append(_Sender(sender, data))
+        self.assertEqual(len(self.mappings), 1)
+        self.assertEqual(self.mappings.get_users(keys[0]), RECEIVERS)
+        for thread in threads:
+            thread.start()
+        peak = rss
+        while any(thread.is_alive() for thread in threads):
+            peak = max(peak, _get_anonymous_rss())
+            threads[0].join(0.05)
+
+        for receiver in threads[::2]:
+            self.assertEqual(receiver.received, BIG_FILE_SIZE)
+        self.assertTrue(peak - rss < RSS_SLACK,
+                        'anonymous memory grew by %d kB' % (peak - rss))
+        for key in keys:
+            self.mappings.unmap(key)
+        self.assertEqual(len(self.mappings), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
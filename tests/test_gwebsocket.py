@@ -0,0 +1,131 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Tests of the main loop driven client against a local server.  They need
+gi, and are skipped without it.
+'''
+
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import websocket
+from websocket import ABNF
+
+from wsserver import EchoServer
+
+try:
+    from gi.repository import GLib
+    import gwebsocket
+except ImportError:
+    gwebsocket = None
+
+# seconds a test may run the main loop.
+TIMEOUT = 10
+
+
+@unittest.skipIf(gwebsocket is None, 'gi is not installed')
+class WebSocketTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EchoServer()
+        self.loop = GLib.MainLoop()
+        self.ws = gwebsocket.WebSocketTransport()
+        self.events = []
+        self.ws.connect('open', self.__open_cb)
+        self.ws.connect('message', self.__message_cb)
+        self.ws.connect('close', self.__close_cb)
+        self.ws.connect('progress', self.__progress_cb)
+        self.progress = []
+        self.on_open = None
+
+    def tearDown(self):
+        self.server.close()
+
+    def __open_cb(self, ws):
+        self.events.append(('open',))
+        if self.on_open is not None:
+            self.on_open()
+
+    def __message_cb(self, ws, opcode, data):
+        self.events.append(('message', opcode, data))
+
+    def __close_cb(self, ws, status, reason):
+        self.events.append(('close', status))
+        self.loop.quit()
+
+    def __progress_cb(self, ws, sent, queued):
+        self.progress.append((sent, queued))
+
+    def _run(self):
+        timeout_id = GLib.timeout_add_seconds(TIMEOUT, self.loop.quit)
+        self.loop.run()
+        GLib.source_remove(timeout_id)
+
+    def _messages(self):
+        return [event[1:] for event in self.events if event[0] == 'message']
+
+    def test_echo(self):
+        big = os.urandom(1 << 20)
+        messages = [(ABNF.OPCODE_TEXT, 'hello'),
+                    (ABNF.OPCODE_BINARY, big),
+                    (ABNF.OPCODE_BINARY, big[:1000])]
+
+        def send():
+            self.ws.send('hello')
+            self.ws.send(big, ABNF.OPCODE_BINARY)
+            self.ws.send_stream(big, ABNF.OPCODE_BINARY, length=1000)
+
+        def message_cb(ws, opcode, data):
+            if len(self._messages()) == len(messages):
+                ws.close()
+
+        self.on_open = send
+        self.ws.connect('message', message_cb)
+        self.ws.open(self.server.url)
+        self._run()
+        self.assertEqual(self.events[0], ('open',))
+        self.assertEqual(self._messages(), messages)
+        self.assertEqual(self.events[-1],
+                         ('close', websocket.STATUS_NORMAL))
+        self.assertFalse(self.ws.is_open())
+        # the megabyte went out over several main loop callbacks.
+        self.assertTrue(len(self.progress) > 1)
+        self.assertEqual(self.progress[-1][0], self.ws.queued)
+
+    def test_server_closes(self):
+        self.on_open = self.server.close
+        self.ws.open(self.server.url)
+        self._run()
+        self.assertEqual(self.events[0], ('open',))
+        self.assertEqual(self.events[-1][0], 'close')
+        self.assertEqual(len(self.events), 2)
+
+    def test_connection_refused(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        self.ws.open('ws://127.0.0.1:%d/websocket' % port)
+        self._run()
+        self.assertEqual([event[0] for event in self.events], ['close'])
+
+
+if __name__ == '__main__':
+    unittest.main()
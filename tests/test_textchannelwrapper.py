@@ -0,0 +1,167 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Tests of the file transfer helpers of the collaboration wrapper.  They
+need gi, telepathy and sugar3, and are skipped without them.
+'''
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+try:
+    from gi.repository import Gio
+    from gi.repository import GLib
+    import textchannelwrapper
+except ImportError:
+    textchannelwrapper = None
+
+# size of the file sent to the fake receivers.
+BIG_FILE_SIZE = 500 * 1024 * 1024
+RECEIVERS = 4
+# anonymous memory the transfers may add, in kB.
+RSS_SLACK = 32 * 1024
+
+
+def _get_anonymous_rss():
+    # kB of anonymous memory, the mapped file pages are not counted.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+class _Receiver(threading.Thread):
+    '''Reads a socket to the end, keeping only the byte count.'''
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._sock = sock
+        self.received = 0
+
+    def run(self):
+        while True:
+            data = self._sock.recv(1 << 16)
+            if not data:
+                break
+            self.received += len(data)
+        self._sock.close()
+
+
+@unittest.skipIf(textchannelwrapper is None,
+                 'gi, telepathy or sugar3 is not installed')
+class MapFileTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, 'journal entry' * 1000)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_truncated_file_leaves_the_bytes(self):
+        expected = open(self.path, 'rb').read()
+        key, data = textchannelwrapper._map_file(self.path)
+        # reading past the end of a truncated mapped file is a SIGBUS.
+        open(self.path, 'wb').close()
+        self.assertEqual(data.get_data(), expected)
+        textchannelwrapper._unmap_file(key)
+
+    def test_streams_share_the_bytes(self):
+        key, data = textchannelwrapper._map_file(self.path)
+        expected = open(self.path, 'rb').read()
+        streams = [Gio.MemoryInputStream.new_from_bytes(data)
+                   for i in range(3)]
+        # the streams are read independently, each from its own offset.
+        for size in (10, 100, len(expected)):
+            for stream in streams:
+                stream.read_bytes(size, None)
+        for stream in streams:
+            stream.seek(0, GLib.SeekType.SET, None)
+            read = stream.read_bytes(len(expected), None).get_data()
+            self.assertEqual(read, expected)
+            stream.close(None)
+        textchannelwrapper._unmap_file(key)
+
+    @unittest.skipIf(_get_anonymous_rss() is None, 'RssAnon is not reported')
+    def test_big_file_to_several_receivers(self):
+        st = os.statvfs(os.path.dirname(self.path))
+        if st.f_bavail * st.f_frsize < 2 * BIG_FILE_SIZE:
+            self.skipTest('no disk space for the file and its copy')
+        # a sparse file; the copy takes the disk space.
+        with open(self.path, 'wb') as big_file:
+            big_file.truncate(BIG_FILE_SIZE)
+        rss = _get_anonymous_rss()
+        loop = GLib.MainLoop()
+        receivers = []
+        pending = [RECEIVERS]
+        peak = [rss]
+
+        def spliced_cb(output, result, user_data):
+            output.splice_finish(result)
+            peak[0] = max(peak[0], _get_anonymous_rss())
+            pending[0] -= 1
+            if not pending[0]:
+                loop.quit()
+
+        keys = []
+        for i in range(RECEIVERS):
+            key, data = textchannelwrapper._map_file(self.path)
+            keys.append(key)
+            sender, receiver = socket.socketpair()
+            receivers.append(_Receiver(receiver))
+            receivers[-1].start()
+            output = Gio.UnixOutputStream.new(os.dup(sender.fileno()), True)
+            sender.close()
+            output.splice_async(
+                Gio.MemoryInputStream.new_from_bytes(data),
+                Gio.OutputStreamSpliceFlags.CLOSE_SOURCE |
+                Gio.OutputStreamSpliceFlags.CLOSE_TARGET,
+                GLib.PRIORITY_LOW, None, spliced_cb, None)
+        self.assertEqual(len(textchannelwrapper._mapped_files), 1)
+        self.assertEqual(
+            textchannelwrapper._mapped_files.get_users(keys[0]), RECEIVERS)
+
+        def sample_cb():
+            peak[0] = max(peak[0], _get_anonymous_rss())
+            return True
+        sample_id = GLib.timeout_add(50, sample_cb)
+        loop.run()
+        GLib.source_remove(sample_id)
+
+        for receiver in receivers:
+            receiver.join()
+            self.assertEqual(receiver.received, BIG_FILE_SIZE)
+        self.assertTrue(peak[0] - rss < RSS_SLACK,
+                        'anonymous memory grew by %d kB' % (peak[0] - rss))
+        for key in keys:
+            textchannelwrapper._unmap_file(key)
+        self.assertEqual(len(textchannelwrapper._mapped_files), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
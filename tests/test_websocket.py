@@ -0,0 +1,379 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+Tests of the websocket client, against fake sockets or a local server.
+Run them from the top directory with:
+
+    python -m unittest discover tests
+'''
+
+import base64
+import os
+import random
+import sha
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import websocket
+from websocket import ABNF
+
+from wsserver import EchoServer
+
+if websocket.asyncio is not None:
+    from trollius import From, Return
+
+
+def mask_bytewise(mask_key, data):
+    # the byte at a time masking the word at a time one replaced.
+    _m = map(ord, mask_key)
+    _d = map(ord, data)
+    for i in range(len(_d)):
+        _d[i] ^= _m[i % 4]
+    s = map(chr, _d)
+    return "".join(s)
+
+
+def server_frame(opcode, data, fin=1, rsv1=0, mask=0):
+    # servers do not mask their frames, but a parser must accept both.
+    frame = ABNF(fin, rsv1, 0, 0, opcode, mask, data)
+    return frame.format()
+
+
+class FakeSocket(object):
+    '''
+    A socket connected to a server that accepts the handshake, then sends
+    the frames in stream, piece_size bytes at most per recv.
+    '''
+
+    def __init__(self, stream='', piece_size=4096):
+        self._stream = stream
+        self._piece_size = piece_size
+        self.sent = []
+        self.recv_calls = 0
+        self.response_size = 0
+
+    def send(self, data):
+        self.sent.append(data)
+        for line in data.split('\r\n'):
+            if line.startswith('Sec-WebSocket-Key:'):
+                key = line.split(':', 1)[1].strip()
+                accept = base64.b64encode(sha.sha(
+                    key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+                response = ('HTTP/1.1 101 Switching Protocols\r\n'
+                            'Upgrade: websocket\r\n'
+                            'Connection: Upgrade\r\n'
+                            'Sec-WebSocket-Accept: %s\r\n'
+                            '\r\n' % accept)
+                self.response_size = len(response)
+                self._stream = response + self._stream
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def recv(self, size):
+        self.recv_calls += 1
+        data = self._stream[:min(size, self._piece_size)]
+        self._stream = self._stream[len(data):]
+        return data
+
+    def recv_into(self, view, size):
+        data = self.recv(size)
+        view[:len(data)] = data
+        return len(data)
+
+
+def fake_connection(stream='', piece_size=4096):
+    ws = websocket.WebSocket()
+    ws.sock.close()
+    ws.io_sock = ws.sock = FakeSocket(stream, piece_size)
+    ws._handshake('127.0.0.1', 8080, '/websocket')
+    return ws
+
+
+class HandshakeTest(unittest.TestCase):
+
+    def test_handshake_is_read_in_blocks(self):
+        ws = fake_connection()
+        self.assertTrue(ws.connected)
+        # the whole response comes in one block, not a byte at a time.
+        self.assertEqual(ws.handshake_recv_calls, 1)
+        self.assertEqual(ws.sock.recv_calls, 1)
+
+    def test_small_pieces(self):
+        ws = fake_connection(piece_size=16)
+        self.assertTrue(ws.connected)
+        # one recv per piece, where a byte at a time needed one per byte.
+        self.assertEqual(ws.handshake_recv_calls,
+                         (ws.sock.response_size + 15) // 16)
+        self.assertTrue(ws.handshake_recv_calls < ws.sock.response_size)
+
+    def test_frames_after_the_handshake_are_kept(self):
+        stream = (server_frame(ABNF.OPCODE_TEXT, 'first') +
+                  server_frame(ABNF.OPCODE_BINARY, 'second'))
+        ws = fake_connection(stream)
+        self.assertEqual(ws.sock.recv_calls, 1)
+        self.assertEqual(ws.recv(), 'first')
+        self.assertEqual(ws.recv(), 'second')
+        # both frames came with the handshake response.
+        self.assertEqual(ws.sock.recv_calls, 1)
+
+
+class MaskTest(unittest.TestCase):
+
+    LENGTHS = [0, 1, 3, 4, 5, 7, 8, 125, 4096, 4099,
+               websocket._MASK_BLOCK_SIZE - 1, websocket._MASK_BLOCK_SIZE,
+               websocket._MASK_BLOCK_SIZE + 5, 3 * websocket._MASK_BLOCK_SIZE]
+
+    def setUp(self):
+        self.random = random.Random(1)
+
+    def _check(self, mask):
+        for length in self.LENGTHS:
+            data = os.urandom(length)
+            mask_key = os.urandom(4)
+            expected = mask_bytewise(mask_key, data)
+            self.assertEqual(mask(mask_key, data), expected)
+            self.assertEqual(mask(mask_key, bytearray(data)), expected)
+            self.assertEqual(mask(mask_key, memoryview(data)), expected)
+
+    def test_mask_matches_bytewise(self):
+        self._check(ABNF.mask)
+
+    def test_mask_long_matches_bytewise(self):
+        self._check(websocket._mask_long)
+
+    @unittest.skipIf(websocket.numpy is None, 'numpy is not installed')
+    def test_mask_numpy_matches_bytewise(self):
+        self._check(websocket._mask_numpy)
+
+    def test_mask_round_trip(self):
+        data = os.urandom(100003)
+        mask_key = os.urandom(4)
+        self.assertEqual(ABNF.mask(mask_key, ABNF.mask(mask_key, data)), data)
+
+
+class PerMessageDeflateTest(unittest.TestCase):
+
+    def _frames(self, response):
+        deflate = websocket._PerMessageDeflate()
+        self.assertTrue(deflate.accept(response))
+        return deflate, list(websocket._create_message_frames(
+            'hello ' * 100, ABNF.OPCODE_TEXT, 0, deflate))
+
+    def test_window_bits(self):
+        deflate, frames = self._frames(
+            'permessage-deflate; client_max_window_bits=10')
+        self.assertTrue(deflate.compressing)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0].rsv1, 1)
+        self.assertEqual(deflate.decompress(frames[0].data, True),
+                         'hello ' * 100)
+
+    def test_unsupported_window_bits(self):
+        # zlib cannot compress with an 8 bit window, the messages are sent
+        # uncompressed rather than with a larger window than agreed.
+        deflate, frames = self._frames(
+            'permessage-deflate; client_max_window_bits=8')
+        self.assertFalse(deflate.compressing)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0].rsv1, 0)
+        self.assertEqual(frames[0].data, 'hello ' * 100)
+        streamed = ''.join(websocket._iter_stream(
+            'hello', ABNF.OPCODE_TEXT, None, 4096, os.urandom, deflate))
+        # fin set, rsv1 clear.
+        self.assertEqual(ord(streamed[0]), 0x80 | ABNF.OPCODE_TEXT)
+        self.assertEqual(len(streamed), 2 + 4 + len('hello'))
+
+
+class ABNFParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(1)
+        self.frames = [
+            (ABNF.OPCODE_TEXT, 'hello', 1, 0, 0),
+            (ABNF.OPCODE_TEXT, '', 1, 0, 0),
+            (ABNF.OPCODE_BINARY, os.urandom(125), 1, 0, 1),
+            (ABNF.OPCODE_BINARY, os.urandom(126), 1, 1, 0),
+            (ABNF.OPCODE_PING, 'ping', 1, 0, 0),
+            (ABNF.OPCODE_BINARY, os.urandom(65535), 0, 0, 1),
+            (ABNF.OPCODE_CONT, os.urandom(70000), 1, 0, 0),
+            (ABNF.OPCODE_TEXT, 'x' * 1000, 0, 0, 0),
+            (ABNF.OPCODE_PONG, '', 1, 0, 1),
+            (ABNF.OPCODE_CONT, 'y' * 3, 1, 0, 1),
+            (ABNF.OPCODE_CLOSE, '\x03\xe8bye', 1, 0, 0),
+        ]
+        self.stream = ''.join(server_frame(opcode, data, fin, rsv1, mask)
+                              for opcode, data, fin, rsv1, mask
+                              in self.frames)
+
+    def _split(self, count):
+        points = sorted(self.random.sample(xrange(1, len(self.stream)),
+                                           count))
+        pieces = []
+        start = 0
+        for point in points + [len(self.stream)]:
+            pieces.append(self.stream[start:point])
+            start = point
+        return pieces
+
+    def _feed(self, parser, pieces):
+        frames = []
+        for piece in pieces:
+            frames.extend(parser.feed(piece))
+        return frames
+
+    def _check_frames(self, frames):
+        self.assertEqual(len(frames), len(self.frames))
+        for frame, (opcode, data, fin, rsv1, mask) in zip(frames,
+                                                          self.frames):
+            self.assertEqual(frame.opcode, opcode)
+            self.assertEqual(frame.fin, fin)
+            self.assertEqual(frame.rsv1, rsv1)
+            self.assertEqual(frame.mask, mask)
+            self.assertEqual(str(frame.data), data)
+
+    def test_whole_stream(self):
+        parser = websocket.ABNFParser()
+        self._check_frames(parser.feed(self.stream))
+        self.assertEqual(parser.frames, len(self.frames))
+        self.assertEqual(parser.bytes_fed, len(self.stream))
+
+    def test_byte_at_a_time(self):
+        self._check_frames(self._feed(websocket.ABNFParser(),
+                                      list(self.stream)))
+
+    def test_random_split_points(self):
+        for count in (1, 2, 10, 100, 1000):
+            for i in range(10):
+                frames = self._feed(websocket.ABNFParser(),
+                                    self._split(count))
+                self._check_frames(frames)
+
+    def test_random_split_points_chunked(self):
+        chunk_size = 4096
+        for count in (1, 10, 100, 1000):
+            for i in range(5):
+                parser = websocket.ABNFParser(chunk_size)
+                frames = []
+                current = None
+                for piece in self._feed(parser, self._split(count)):
+                    if current is None:
+                        current = piece
+                        current.data = bytearray(piece.data)
+                    else:
+                        self.assertEqual(piece.opcode, ABNF.OPCODE_CONT)
+                        current.data += piece.data
+                        current.fin = piece.fin
+                    # the pieces of a frame add up to its payload.
+                    if len(current.data) == len(self.frames[len(frames)][1]):
+                        frames.append(current)
+                        current = None
+                self._check_frames(frames)
+
+    def test_chunks_before_the_frame_ends(self):
+        parser = websocket.ABNFParser(4096)
+        frame = server_frame(ABNF.OPCODE_BINARY, 'z' * 70000)
+        self.assertEqual(parser.feed(frame[:4000]), [])
+        pieces = parser.feed(frame[4000:10000])
+        self.assertEqual(len(pieces), 1)
+        self.assertEqual(pieces[0].opcode, ABNF.OPCODE_BINARY)
+        self.assertEqual(pieces[0].fin, 0)
+        pieces = parser.feed(frame[10000:])
+        self.assertEqual(len(pieces), 1)
+        self.assertEqual(pieces[0].opcode, ABNF.OPCODE_CONT)
+        self.assertEqual(pieces[0].fin, 1)
+        self.assertEqual(len(pieces[0].data), len(frame) - 10000)
+
+    def test_partial_header_is_kept(self):
+        parser = websocket.ABNFParser()
+        frame = server_frame(ABNF.OPCODE_BINARY, 'z' * 70000)
+        self.assertEqual(parser.feed(frame[:1]), [])
+        self.assertEqual(parser.feed(frame[1:5]), [])
+        self.assertEqual(parser.feed(frame[5:-1]), [])
+        frames = parser.feed(frame[-1:] + server_frame(ABNF.OPCODE_TEXT,
+                                                       'next'))
+        self.assertEqual([str(f.data) for f in frames],
+                         ['z' * 70000, 'next'])
+
+
+class EchoTest(unittest.TestCase):
+
+    MESSAGES = [(ABNF.OPCODE_TEXT, 'hello'),
+                (ABNF.OPCODE_TEXT, ''),
+                (ABNF.OPCODE_BINARY, os.urandom(300 * 1024)),
+                (ABNF.OPCODE_TEXT, 'bye')]
+
+    def setUp(self):
+        self.server = EchoServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_blocking_client(self):
+        ws = websocket.create_connection(self.server.url)
+        for opcode, data in self.MESSAGES:
+            ws.send(data, opcode)
+            self.assertEqual(ws.recv_data(), (opcode, data))
+        ws.close()
+        self.assertFalse(ws.connected)
+
+    @unittest.skipIf(websocket.asyncio is None, 'trollius is not installed')
+    def test_async_client(self):
+        loop = websocket.asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        @websocket.asyncio.coroutine
+        def echo():
+            ws = yield From(websocket.create_async_connection(
+                self.server.url, loop=loop))
+            received = []
+            for opcode, data in self.MESSAGES:
+                yield From(ws.send(data, opcode))
+                received.append((yield From(ws.recv_data())))
+            yield From(ws.close())
+            raise Return((ws, received))
+
+        ws, received = loop.run_until_complete(echo())
+        self.assertEqual(received, self.MESSAGES)
+        self.assertFalse(ws.connected)
+
+    @unittest.skipIf(websocket.asyncio is None, 'trollius is not installed')
+    def test_async_clients_share_a_loop(self):
+        loop = websocket.asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        @websocket.asyncio.coroutine
+        def echo(index):
+            ws = yield From(websocket.create_async_connection(
+                self.server.url, loop=loop))
+            yield From(ws.send('client %d' % index))
+            data = yield From(ws.recv())
+            yield From(ws.close())
+            raise Return(data)
+
+        tasks = [echo(index) for index in range(10)]
+        received = loop.run_until_complete(
+            websocket.asyncio.gather(*tasks, loop=loop))
+        self.assertEqual(received, ['client %d' % index
+                                    for index in range(10)])
+        self.assertEqual(self.server.connections, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
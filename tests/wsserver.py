@@ -0,0 +1,131 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+'''
+WebSocket servers on a local port, for the tests and benchmarks of the
+clients.
+'''
+
+import base64
+import os
+import sha
+import socket
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import websocket
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class WebSocketServer(object):
+    '''
+    Accepts connections on 127.0.0.1, each in its own thread, and passes
+    the messages to serve_message until the client closes.
+    '''
+
+    path = '/websocket'
+
+    def __init__(self):
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._connections = []
+        self._listener = socket.socket()
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(128)
+        self.url = 'ws://127.0.0.1:%d%s' % (
+            self._listener.getsockname()[1], self.path)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._listener.close()
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def serve_connection(self, ws):
+        '''Called with each new connection, before its messages.'''
+        pass
+
+    def serve_message(self, ws, opcode, data):
+        pass
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()[0]
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        with self._lock:
+            self.connections += 1
+            self._connections.append(conn)
+        try:
+            ws = self._handshake(conn)
+            self.serve_connection(ws)
+            while True:
+                opcode, data = ws.recv_data()
+                if data is None:
+                    break
+                self.serve_message(ws, opcode, data)
+        except (socket.error, websocket.WebSocketException):
+            pass
+        finally:
+            with self._lock:
+                self._connections.remove(conn)
+            conn.close()
+
+    def _handshake(self, conn):
+        request = ''
+        while '\r\n\r\n' not in request:
+            data = conn.recv(4096)
+            if not data:
+                raise socket.error('closed during the handshake')
+            request += data
+        head, rest = request.split('\r\n\r\n', 1)
+        for line in head.split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.lower() == 'sec-websocket-key':
+                key = value.strip()
+        accept = base64.b64encode(sha.sha(key + GUID).digest())
+        conn.sendall('HTTP/1.1 101 Switching Protocols\r\n'
+                     'Upgrade: websocket\r\n'
+                     'Connection: Upgrade\r\n'
+                     'Sec-WebSocket-Accept: %s\r\n\r\n' % accept)
+        ws = websocket.WebSocket()
+        ws.sock.close()
+        ws.io_sock = ws.sock = conn
+        ws._recv_buffer = rest
+        ws.connected = True
+        return ws
+
+
+class EchoServer(WebSocketServer):
+    '''Sends every message back.'''
+
+    def serve_message(self, ws, opcode, data):
+        ws.send(data, opcode)
@@ -55,6 +55,13 @@ Using CollabWrapper
 import os
 import json
 import socket
+import struct
+import base64
+import hashlib
+import tempfile
+import uuid
+import decimal
+from collections import OrderedDict
 from gettext import gettext as _
 
 from gi.repository import GObject
@@ -81,15 +88,43 @@ from telepathy.constants import \
 from telepathy.client import Connection, Channel
 
 from sugar3.presence import presenceservice
+from sugar3 import profile
 from sugar3.activity.activity import SCOPE_PRIVATE
 from sugar3.graphics.alert import NotifyAlert, Alert
 
+from filemap import FileMappings
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 import logging
 _logger = logging.getLogger('text-channel-wrapper')
 
 ACTION_INIT_REQUEST = '!!ACTION_INIT_REQUEST'
 ACTION_INIT_RESPONSE = '!!ACTION_INIT_RESPONSE'
 ACTIVITY_FT_MIME = 'x-sugar/from-activity'
+ACTION_BATCH = '!!ACTION_BATCH'
+ACTION_CODECS = '!!ACTION_CODECS'
+# key of the versioned init responses
+SNAPSHOT_KEY = '!!SNAPSHOT'
+# snapshots kept to send deltas from: that many, with the current one,
+# and that many bytes of json text besides the current one
+SNAPSHOT_HISTORY = 8
+SNAPSHOT_HISTORY_BYTES = 8 * 1024 * 1024
+# largest batch envelope, in bytes of json text.
+BATCH_MAX_BYTES = 16 * 1024
+# times the init data is asked for again after a transfer of it failed,
+# before giving up
+INIT_RETRIES = 3
+# transfers a broadcast runs at the same time.
+BROADCAST_LIMIT = 8
+# bytes of a transfer accepted to memory kept in memory, beyond which it
+# is moved to a temporary file.
+SPILL_THRESHOLD = 4 * 1024 * 1024
+# bytes read from a transfer socket at a time.
+TRANSFER_READ_SIZE = 64 * 1024
 
 
 class CollabWrapper(GObject.GObject):
@@ -119,6 +154,21 @@ class CollabWrapper(GObject.GObject):
     :class:`sugar3.presence.filetransfer.IncomingFileTransfer`.  The seccond
     argument is the description, as passed to the `send_file_*` function
     on the sender's client
+    If `batch_interval` is given, in milliseconds, messages posted within
+    that time of each other are sent together in one text message, up to
+    `BATCH_MAX_BYTES`.  Every buddy must run a wrapper that understands
+    batches, but they do not need to batch themselves.
+    If the activity calls `state_changed` whenever the data `get_data`
+    returns changes, the leader encodes each version of the data once,
+    sends the same snapshot to every buddy joining until the next change,
+    and sends buddies that hold an older version only the changes.  The
+    buddies keep the last version they received in the activity's data
+    directory, so one that rejoins after closing the activity gets only
+    the changes too.
+    `codec` is an extra :class:`CompactCodec` to offer.  The buddies
+    announce the codecs they have when they join, and the codec is used
+    once every buddy in the activity has it; until then messages are
+    sent as json.
     '''
 
     message = GObject.Signal('message', arg_types=[object, object])
@@ -127,13 +177,39 @@ class CollabWrapper(GObject.GObject):
     buddy_left = GObject.Signal('buddy_left', arg_types=[object])
     incoming_file = GObject.Signal('incoming_file', arg_types=[object, object])
 
-    def __init__(self, activity):
+    def __init__(self, activity, batch_interval=None, codec=None):
         GObject.GObject.__init__(self)
         self.activity = activity
         self.shared_activity = activity.shared_activity
         self._leader = False
         self._init_waiting = False
+        # init requests sent again since joining
+        self._init_retries = 0
         self._text_channel = None
+        self._batch_interval = batch_interval
+        self._codec = codec
+        # versioned snapshots, on the leader: the version of the data,
+        # None until the activity calls state_changed, the encoded
+        # snapshot of the current version, and version -> the encoded
+        # snapshot of the recent versions.  versions are unique to this
+        # instance, so one from another leader never matches
+        self._state_version = None
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._state_changes = 0
+        self._snapshot = None
+        self._snapshot_history = OrderedDict()
+        self._snapshot_history_bytes = 0
+        # (from version, to version) -> encoded delta
+        self._deltas = {}
+        self.snapshot_hits = 0
+        self.snapshot_misses = 0
+        self.delta_hits = 0
+        # the version received, on the other buddies.  it is kept on
+        # disk with its data, see _save_received
+        self._received_version = None
+        # buddy key -> names of the codecs the buddy announced, for the
+        # buddies in the activity
+        self._buddy_codecs = {}
 
     def setup(self):
         '''
@@ -198,16 +274,22 @@ class CollabWrapper(GObject.GObject):
         self._setup_text_channel()
         self._listen_for_channels()
         self._init_waiting = True
-        self.post({'action': ACTION_INIT_REQUEST})
+        self._init_retries = 0
+        self._request_init()
 
         _logger.debug('I joined a shared activity.')
         self.joined.emit()
 
     def _setup_text_channel(self):
         ''' Set up a text channel to use for collaboration. '''
+        codecs = []
+        if self._codec is not None:
+            codecs.append(self._codec)
         self._text_channel = _TextChannelWrapper(
             self.shared_activity.telepathy_text_chan,
-            self.shared_activity.telepathy_conn)
+            self.shared_activity.telepathy_conn,
+            batch_interval=self._batch_interval,
+            codecs=codecs)
 
         # Tell the text channel what callback to use for incoming
         # text messages.
@@ -218,6 +300,27 @@ class CollabWrapper(GObject.GObject):
         self.shared_activity.connect('buddy-joined', self.__buddy_joined_cb)
         self.shared_activity.connect('buddy-left', self.__buddy_left_cb)
 
+        if self._codec is not None:
+            for buddy in self.shared_activity.get_joined_buddies():
+                if not _is_owner(buddy):
+                    self._buddy_codecs.setdefault(_get_buddy_key(buddy), ())
+            self._announce_codecs(reply=False)
+
+    def _announce_codecs(self, reply):
+        self.post({'action': ACTION_CODECS, 'reply': reply,
+                   'codecs': [codec.name for codec in
+                              self._text_channel.codecs]})
+
+    def _update_codec(self):
+        '''Use the offered codec if every buddy announced it.'''
+        if self._text_channel is None or self._codec is None:
+            return
+        for codecs in self._buddy_codecs.values():
+            if self._codec.name not in codecs:
+                self._text_channel.set_codec(None)
+                return
+        self._text_channel.set_codec(self._codec)
+
     def _listen_for_channels(self):
         conn = self.shared_activity.telepathy_conn
         conn.connect_to_signal('NewChannels', self.__new_channels_cb)
@@ -243,22 +346,204 @@ class CollabWrapper(GObject.GObject):
 
     def __notify_ft_state_cb(self, ft, pspec):
         if ft.props.state == FT_STATE_COMPLETED and self._init_waiting:
-            stream = ft.props.output
-            stream.close(None)
-            # FIXME:  The data prop seems to just be the raw pointer
-            gbytes = stream.steal_as_bytes()
-            data = gbytes.get_data()
-            logging.debug('Got init data from buddy:  %s', data)
-            data = json.loads(data)
-            self.activity.set_data(data)
+            output = ft.props.output
+            # the socket may still hold data when telepathy is done
+            if output.done:
+                self.__init_data_cb(output)
+            else:
+                output.finished.connect(self.__init_data_cb)
+
+    def __init_data_cb(self, output):
+        if not self._init_waiting:
+            return
+        logging.debug('Got %d bytes of init data from buddy, %d on disk',
+                      output.size, output.spilled_bytes)
+        error = output.error
+        if error is None:
+            try:
+                data = output.load_json()
+            except ValueError, e:
+                error = e
+        output.discard()
+        if error is not None:
+            # a truncated transfer; ask for the data again
+            logging.error('Cannot read the init data: %s', error)
+            self._retry_init()
+            return
+        if isinstance(data, dict) and SNAPSHOT_KEY in data:
+            version = data[SNAPSHOT_KEY]
+            if 'patch' in data:
+                base = None
+                if data['base'] == self._received_version:
+                    base = self._load_received_data()
+                if base is None:
+                    # not the version this patch is for; ask for it all
+                    self._forget_received()
+                    self._retry_init()
+                    return
+                data = _apply_patch(base, data['patch'])
+            else:
+                data = data['data']
+            if version is not None:
+                self._save_received(version, data)
+        self.activity.set_data(data)
+        self._init_waiting = False
+
+    def _retry_init(self):
+        '''
+        Ask for the init data again, unless it was asked for INIT_RETRIES
+        times already; then stop waiting for it and tell the user.
+        '''
+        if self._init_retries >= INIT_RETRIES:
+            _logger.error('Giving up on the init data after %d retries',
+                          self._init_retries)
             self._init_waiting = False
+            self._alert(_('Cannot join the activity'),
+                        _('The shared data could not be received. '
+                          'Please try joining again.'))
+            return
+        self._init_retries += 1
+        self._request_init()
+
+    def _request_init(self):
+        if self._received_version is None:
+            self._received_version = self._load_received_version()
+        # the version says this wrapper understands versioned snapshots
+        self.post({'action': ACTION_INIT_REQUEST,
+                   'version': self._received_version})
+
+    def _get_received_path(self):
+        '''Return the file holding the last snapshot received, or None.'''
+        data_dir = os.path.join(self.activity.get_activity_root(), 'data')
+        if not os.path.isdir(data_dir):
+            return None
+        return os.path.join(data_dir,
+                            'collab-snapshot-%s' % self.activity.get_id())
+
+    def _save_received(self, version, data):
+        '''
+        Keep the version and the data received for the next join.  The
+        file holds the version on the first line, then the data, as json.
+        '''
+        self._received_version = version
+        path = self._get_received_path()
+        if path is None:
+            return
+        try:
+            fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as part:
+                part.write(json.dumps(version) + '\n')
+                json.dump(data, part)
+            os.rename(part_path, path)
+        except (IOError, OSError), e:
+            logging.error('Cannot save the snapshot received: %s', e)
+
+    def _load_received_version(self):
+        path = self._get_received_path()
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as received:
+                return json.loads(received.readline())
+        except (IOError, ValueError), e:
+            logging.error('Cannot read the snapshot received: %s', e)
+            return None
+
+    def _load_received_data(self):
+        path = self._get_received_path()
+        if path is None:
+            return None
+        try:
+            with open(path) as received:
+                received.readline()
+                return json.load(received)
+        except (IOError, ValueError), e:
+            logging.error('Cannot read the snapshot received: %s', e)
+            return None
+
+    def _forget_received(self):
+        self._received_version = None
+        path = self._get_received_path()
+        if path is not None and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError, e:
+                logging.error('Cannot remove the snapshot received: %s', e)
+
+    def state_changed(self):
+        '''
+        Tell the wrapper that the data returned by `get_data` changed, so
+        the next buddy to join gets a new snapshot.
+        '''
+        self._state_changes += 1
+        self._state_version = '%s:%d' % (self._instance_id,
+                                         self._state_changes)
+        self._snapshot = None
+
+    def _get_snapshot(self):
+        '''Return the version and the encoded snapshot of the data.'''
+        if self._snapshot is not None:
+            self.snapshot_hits += 1
+            return self._snapshot
+        self.snapshot_misses += 1
+        version = self._state_version
+        data = self.activity.get_data()
+        snapshot = (version, json.dumps({SNAPSHOT_KEY: version,
+                                         'data': data}))
+        if version is None:
+            # unversioned data may change at any time
+            return snapshot
+        self._snapshot = snapshot
+        # the encoded snapshot, which the activity cannot change in
+        # place, and which is decoded as the buddies decode it
+        self._snapshot_history[version] = snapshot[1]
+        self._snapshot_history_bytes += len(snapshot[1])
+        while len(self._snapshot_history) > SNAPSHOT_HISTORY or \
+                (self._snapshot_history_bytes - len(snapshot[1]) >
+                 SNAPSHOT_HISTORY_BYTES):
+            self._snapshot_history_bytes -= \
+                len(self._snapshot_history.popitem(last=False)[1])
+        for key in self._deltas.keys():
+            if key[1] != version:
+                del self._deltas[key]
+        return snapshot
+
+    def _get_init_blob(self, version):
+        current, snapshot = self._get_snapshot()
+        if version is None or current is None or \
+                version not in self._snapshot_history:
+            return snapshot
+        key = (version, current)
+        delta = self._deltas.get(key)
+        if delta is not None:
+            self.delta_hits += 1
+            return delta
+        base = json.loads(self._snapshot_history[version])['data']
+        data = json.loads(snapshot)['data']
+        delta = json.dumps({SNAPSHOT_KEY: current, 'base': version,
+                            'patch': _make_patch(base, data)})
+        if len(delta) >= len(snapshot):
+            delta = snapshot
+        self._deltas[key] = delta
+        return delta
 
     def __received_cb(self, buddy, msg):
         '''Process a message when it is received.'''
         action = msg.get('action')
+        if action == ACTION_CODECS:
+            if self._codec is not None and buddy is not None:
+                self._buddy_codecs[_get_buddy_key(buddy)] = \
+                    msg.get('codecs', ())
+                if not msg.get('reply'):
+                    self._announce_codecs(reply=True)
+                self._update_codec()
+            return
         if action == ACTION_INIT_REQUEST and self._leader:
-            data = self.activity.get_data()
-            data = json.dumps(data)
+            if 'version' in msg:
+                data = self._get_init_blob(msg['version'])
+            else:
+                # an older wrapper, which wants the bare data
+                data = json.dumps(self.activity.get_data())
             OutgoingBlobTransfer(
                 buddy,
                 self.shared_activity.telepathy_conn,
@@ -315,6 +600,50 @@ class CollabWrapper(GObject.GObject):
             json.dumps(description),
             ACTIVITY_FT_MIME)
 
+    def broadcast_file_memory(self, buddies, data, description,
+                              limit=BROADCAST_LIMIT):
+        '''
+        Send a transfer from memory to several buddies, `limit` of them
+        at a time.  The data is shared by all the transfers, not copied.
+        Args:
+            buddies (list), the buddies to offer the transfer to
+            data (str), the data to offer to the buddies
+            description (object), a json encodable description for the
+                transfer, as for `send_file_memory`
+            limit (int), most transfers to run at the same time
+        Returns: :class:`BroadcastTransfer`, to follow the progress
+        '''
+        broadcast = BroadcastTransfer(
+            buddies, GLib.Bytes.new(data), self.shared_activity.telepathy_conn,
+            self.get_client_name(), json.dumps(description),
+            ACTIVITY_FT_MIME, limit)
+        broadcast.start()
+        return broadcast
+
+    def broadcast_file_file(self, buddies, path, description,
+                            limit=BROADCAST_LIMIT):
+        '''
+        Send a transfer from a file to several buddies, `limit` of them
+        at a time.  A copy of the file is mapped once, and the transfers
+        share the mapping.
+        Args:
+            buddies (list), the buddies to offer the transfer to
+            path (str), path of the file to send to the buddies
+            description (object), a json encodable description for the
+                transfer, as for `send_file_file`
+            limit (int), most transfers to run at the same time
+        Returns: :class:`BroadcastTransfer`, to follow the progress
+        Raises: IOError or OSError, if the file cannot be copied
+        '''
+        key, data = _map_file(path)
+        broadcast = BroadcastTransfer(
+            buddies, data, self.shared_activity.telepathy_conn,
+            self.get_client_name(), json.dumps(description),
+            ACTIVITY_FT_MIME, limit)
+        broadcast.finished.connect(lambda broadcast: _unmap_file(key))
+        broadcast.start()
+        return broadcast
+
     def post(self, msg):
         '''
         Broadcast a message to the other buddies if the activity is
@@ -329,10 +658,22 @@ class CollabWrapper(GObject.GObject):
 
     def __buddy_joined_cb(self, sender, buddy):
         '''A buddy joined.'''
+        if self._text_channel is not None:
+            # a buddy coming back may have a new handle
+            self._text_channel.forget_buddy(buddy)
+            if self._codec is not None:
+                # json until the buddy announces its codecs, which may
+                # have arrived before this signal.
+                self._buddy_codecs.setdefault(_get_buddy_key(buddy), ())
+                self._update_codec()
         self.buddy_joined.emit(buddy)
 
     def __buddy_left_cb(self, sender, buddy):
         '''A buddy left.'''
+        if self._text_channel is not None:
+            self._text_channel.forget_buddy(buddy)
+            self._buddy_codecs.pop(_get_buddy_key(buddy), None)
+            self._update_codec()
         self.buddy_left.emit(buddy)
 
     def get_client_name(self):
@@ -458,11 +799,12 @@ class IncomingFileTransfer(_BaseFileTransfer):
     the transfer (either to memory or to a file).  Then you need to listen
     to the state and wait until the transfer is completed.  Then you can
     read the file that it was saved to, or access the
-    :class:`Gio.MemoryOutputStream` from the `output` property.
+    :class:`SpooledOutput` from the `output` property.
     The `output` property is different depending on how the file was accepted.
     If the file was accepted to a file on the file system, it is a string
     representing the path to the file.  If the file was accepted to memory,
-    it is a :class:`Gio.MemoryOutputStream`.
+    it is a :class:`SpooledOutput`, which moves to a temporary file once
+    the transfer outgrows its threshold.
     '''
 
     def __init__(self, connection, object_path, props):
@@ -474,6 +816,7 @@ class IncomingFileTransfer(_BaseFileTransfer):
         self.connect('notify::state', self.__notify_state_cb)
 
         self._destination_path = None
+        self._spill_threshold = SPILL_THRESHOLD
         self._output_stream = None
         self._socket_address = None
         self._socket = None
@@ -494,11 +837,15 @@ class IncomingFileTransfer(_BaseFileTransfer):
         self._destination_path = destination_path
         self._accept()
 
-    def accept_to_memory(self):
+    def accept_to_memory(self, spill_threshold=SPILL_THRESHOLD):
         '''
         Accept the file transfer.  Once the state is FT_STATE_OPEN, a
-        :class:`Gio.MemoryOutputStream` accessible via the output prop.
+        :class:`SpooledOutput` is accessible via the output prop.
+        Args:
+            spill_threshold (int): bytes to keep in memory, beyond which
+                the data is moved to a temporary file
         '''
+        self._spill_threshold = spill_threshold
         self._accept()
 
     def _accept(self):
@@ -519,16 +866,18 @@ class IncomingFileTransfer(_BaseFileTransfer):
             self._socket.connect(self._socket_address)
             input_stream = Gio.UnixInputStream.new(self._socket.fileno(), True)
 
-            if self._destination_path is not None:
-                destination_file = Gio.File.new_for_path(
-                    self._destination_path)
-                if self.initial_offset == 0:
-                    self._output_stream = destination_file.create(
-                        Gio.FileCreateFlags.PRIVATE, None)
-                else:
-                    self._output_stream = destination_file.append_to()
+            if self._destination_path is None:
+                self._output_stream = SpooledOutput(self._spill_threshold)
+                self._read_to_output(input_stream)
+                return
+
+            destination_file = Gio.File.new_for_path(
+                self._destination_path)
+            if self.initial_offset == 0:
+                self._output_stream = destination_file.create(
+                    Gio.FileCreateFlags.PRIVATE, None)
             else:
-                self._output_stream = Gio.MemoryOutputStream.new_resizable()
+                self._output_stream = destination_file.append_to()
 
             self._output_stream.splice_async(
                 input_stream,
@@ -536,11 +885,117 @@ class IncomingFileTransfer(_BaseFileTransfer):
                 Gio.OutputStreamSpliceFlags.CLOSE_TARGET,
                 GLib.PRIORITY_LOW, None, None, None)
 
+    def _read_to_output(self, input_stream):
+        input_stream.read_bytes_async(
+            TRANSFER_READ_SIZE, GLib.PRIORITY_LOW, None, self.__read_cb, None)
+
+    def __read_cb(self, input_stream, result, user_data):
+        try:
+            data = input_stream.read_bytes_finish(result).get_data()
+        except GLib.Error, e:
+            logging.error('reading the transfer failed: %s', e)
+            data = None
+            self._output_stream.error = e
+        if not data:
+            input_stream.close(None)
+            self._output_stream.finish()
+            return
+        self._output_stream.write(data)
+        self._read_to_output(input_stream)
+
     @GObject.Property
     def output(self):
         return self._destination_path or self._output_stream
 
 
+class SpooledOutput(GObject.GObject):
+    '''
+    Holds a transfer accepted to memory.  The data stays in memory up to
+    `threshold` bytes; past that all of it is moved to a temporary file,
+    so a large transfer does not have to fit in RAM.
+    The `finished` signal is emitted, and `done` is set, once all the
+    data was written.  `size` is the number of bytes received and
+    `spilled_bytes` the number of them written to disk.  `error` is set
+    if the transfer could not be read to the end.
+    '''
+
+    finished = GObject.Signal('finished')
+
+    def __init__(self, threshold=SPILL_THRESHOLD):
+        GObject.GObject.__init__(self)
+        self._threshold = threshold
+        self._file = tempfile.SpooledTemporaryFile(threshold)
+        self.size = 0
+        self.spilled_bytes = 0
+        self.done = False
+        self.error = None
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+        if self.size > self._threshold:
+            # the file has rolled over to disk
+            self.spilled_bytes = self.size
+
+    def finish(self):
+        self.done = True
+        self.finished.emit()
+
+    def open(self):
+        '''Return a file object to read the data from the start.'''
+        self._file.seek(0)
+        return self._file
+
+    def get_data(self):
+        '''Return all the data as a string.'''
+        return self.open().read()
+
+    def load_json(self):
+        '''
+        Decode the data as json.  With ijson installed the file is parsed
+        as it is read, so the text is never held in memory as a whole.
+        Raises ValueError if the data is not valid json.
+        '''
+        if ijson is None:
+            return json.load(self.open())
+        try:
+            try:
+                return next(ijson.items(self.open(), '', use_float=True))
+            except TypeError:
+                # ijson before 3.1 gives a Decimal for every number
+                # with a fraction, where json gives a float
+                return _decimals_to_floats(
+                    next(ijson.items(self.open(), '')))
+        except (ijson.JSONError, StopIteration), e:
+            raise ValueError(str(e) or 'no json data')
+
+    def discard(self):
+        '''Drop the data, and the temporary file if there is one.'''
+        self._file.close()
+
+    def close(self, cancellable=None):
+        '''
+        Does nothing; the data stays readable.  With `steal_as_bytes`, it
+        is kept for code written against :class:`Gio.MemoryOutputStream`.
+        '''
+        pass
+
+    def steal_as_bytes(self):
+        '''Return all the data as GLib.Bytes.'''
+        return GLib.Bytes.new(self.get_data())
+
+
+def _decimals_to_floats(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        for key in value:
+            value[key] = _decimals_to_floats(value[key])
+    elif isinstance(value, list):
+        value[:] = [_decimals_to_floats(item) for item in value]
+    return value
+
+
 class _BaseOutgoingTransfer(_BaseFileTransfer):
     '''
     This class provides the base of an outgoing file transfer.
@@ -570,8 +1025,13 @@ class _BaseOutgoingTransfer(_BaseFileTransfer):
         self._mime = mime
         self.buddy = buddy
 
-    def _create_channel(self, file_size):
-        object_path, properties_ = self._conn.CreateChannel(dbus.Dictionary({
+    def _create_channel(self, file_size, ready_cb=None):
+        '''
+        Create the telepathy channel for the transfer.  If `ready_cb` is
+        given the channel is created without blocking, and
+        ready_cb(transfer, error) is called once it is ready, or failed.
+        '''
+        request = dbus.Dictionary({
             CHANNEL + '.ChannelType': CHANNEL_TYPE_FILE_TRANSFER,
             CHANNEL + '.TargetHandleType': CONNECTION_HANDLE_TYPE_CONTACT,
             CHANNEL + '.TargetHandle': self.buddy.contact_handle,
@@ -579,7 +1039,25 @@ class _BaseOutgoingTransfer(_BaseFileTransfer):
             CHANNEL_TYPE_FILE_TRANSFER + '.Description': self._description,
             CHANNEL_TYPE_FILE_TRANSFER + '.Size': file_size,
             CHANNEL_TYPE_FILE_TRANSFER + '.ContentType': self._mime,
-            CHANNEL_TYPE_FILE_TRANSFER + '.InitialOffset': 0}, signature='sv'))
+            CHANNEL_TYPE_FILE_TRANSFER + '.InitialOffset': 0}, signature='sv')
+        if ready_cb is None:
+            object_path, properties_ = self._conn.CreateChannel(request)
+            self._provide_file(object_path)
+            return
+
+        def created_cb(object_path, properties_):
+            try:
+                self._provide_file(object_path)
+            except dbus.DBusException, e:
+                ready_cb(self, e)
+            else:
+                ready_cb(self, None)
+
+        self._conn.CreateChannel(
+            request, reply_handler=created_cb,
+            error_handler=lambda e: ready_cb(self, e))
+
+    def _provide_file(self, object_path):
         self.set_channel(Channel(self._conn.bus_name, object_path))
 
         channel_file_transfer = self.channel[CHANNEL_TYPE_FILE_TRANSFER]
@@ -607,10 +1085,32 @@ class _BaseOutgoingTransfer(_BaseFileTransfer):
                 GLib.PRIORITY_LOW, None, None, None)
 
 
+# the files being sent, mapped once for all of their transfers
+_mapped_files = FileMappings(
+    lambda fd: GLib.MappedFile.new_from_fd(fd, False).get_bytes())
+
+
+def _map_file(path):
+    '''
+    Map a private copy of the file at path, sharing the mapping with the
+    other users of the same file.  Returns the key to pass to `_unmap_file`
+    when done, and the contents as a GLib.Bytes, which keeps the mapping
+    alive while in use.
+    Raises: IOError or OSError, if the file cannot be copied
+    '''
+    return _mapped_files.map(path)
+
+
+def _unmap_file(key):
+    _mapped_files.unmap(key)
+
+
 class OutgoingFileTransfer(_BaseOutgoingTransfer):
     '''
     An outgoing file transfer to send from a file (on the computer's file
-    system).
+    system).  A copy of the file is mapped into memory rather than read,
+    and the transfers of the same file at the same time share the mapping.
+    If the copy cannot be made, the file is streamed instead.
     Note that the `path` argument is the path for the file that will be
     sent, whereas the `filename` argument is only for metadata.
     Args:
@@ -622,36 +1122,381 @@ class OutgoingFileTransfer(_BaseOutgoingTransfer):
             self, buddy, conn, filename, description, mime)
 
         self._path = path
-        file_size = os.stat(path).st_size
-        self._create_channel(file_size)
+        try:
+            self._mapping_key, self._bytes = _map_file(path)
+        except (IOError, OSError), e:
+            _logger.warning('cannot map a copy of %s, streaming it: %s',
+                            path, e)
+            self._mapping_key = self._bytes = None
+            size = os.path.getsize(path)
+        else:
+            size = self._bytes.get_size()
+        self.connect('notify::state', self.__notify_state_cb)
+        try:
+            self._create_channel(size)
+        except:
+            self._release()
+            raise
 
     def _get_input_stream(self):
-        logging.debug('opening %s for reading', self._file_name)
-        input_stream = Gio.File.new_for_path(self._file_name).read(None)
+        logging.debug('opening %s for reading', self._path)
+        if self._bytes is None:
+            return Gio.File.new_for_path(self._path).read(None)
+        return Gio.MemoryInputStream.new_from_bytes(self._bytes)
+
+    def __notify_state_cb(self, file_transfer, pspec):
+        if self.props.state in (FT_STATE_COMPLETED, FT_STATE_CANCELLED):
+            self._release()
+
+    def _release(self):
+        if self._mapping_key is not None:
+            _unmap_file(self._mapping_key)
+            self._mapping_key = None
+            self._bytes = None
 
 
 class OutgoingBlobTransfer(_BaseOutgoingTransfer):
     '''
     An outgoing file transfer to send from a string in memory.
     Args:
-        blob (str), data to send
+        blob (str or GLib.Bytes), data to send.  GLib.Bytes is shared
+            with the other transfers of the same bytes rather than copied
+        ready_cb (callable), if given, the channel is created without
+            blocking, see `_create_channel`
     '''
 
-    def __init__(self, buddy, conn, blob, filename, description, mime):
+    def __init__(self, buddy, conn, blob, filename, description, mime,
+                 ready_cb=None):
         _BaseOutgoingTransfer.__init__(
             self, buddy, conn, filename, description, mime)
 
         self._blob = blob
-        self._create_channel(len(self._blob))
+        if isinstance(blob, GLib.Bytes):
+            self._create_channel(blob.get_size(), ready_cb)
+        else:
+            self._create_channel(len(self._blob), ready_cb)
 
     def _get_input_stream(self):
+        if isinstance(self._blob, GLib.Bytes):
+            return Gio.MemoryInputStream.new_from_bytes(self._blob)
         return Gio.MemoryInputStream.new_from_data(self._blob, None)
 
 
+class BroadcastTransfer(GObject.GObject):
+    '''
+    Sends the same data to several buddies, with at most `limit`
+    transfers running at a time.  A transfer is running from the
+    channel request until it is completed or cancelled; the next buddy's
+    transfer starts as soon as one finishes.
+    The `progress` signal is emitted with the buddy, its transferred
+    bytes and the size whenever a transfer progresses; the
+    `transferred_bytes` and `total_bytes` attributes give the progress of
+    the whole set.  `finished` is emitted once every transfer completed
+    or failed; `completed` and `failed` list the buddies.
+    '''
+
+    progress = GObject.Signal('progress', arg_types=[object, object, object])
+    finished = GObject.Signal('finished')
+
+    def __init__(self, buddies, data, conn, filename, description, mime,
+                 limit=BROADCAST_LIMIT):
+        GObject.GObject.__init__(self)
+        self._data = data
+        self._conn = conn
+        self._filename = filename
+        self._description = description
+        self._mime = mime
+        self._limit = limit
+        self._waiting = list(buddies)
+        self.size = data.get_size()
+        # buddy -> the buddy's transfer, while it is running
+        self.transfers = {}
+        # buddy -> bytes transferred to the buddy
+        self._transferred = {}
+        self.total_bytes = self.size * len(self._waiting)
+        self.transferred_bytes = 0
+        self.completed = []
+        self.failed = []
+        self._cancelled = False
+
+    def start(self):
+        '''Start the first `limit` transfers.'''
+        while self._waiting and len(self.transfers) < self._limit:
+            buddy = self._waiting.pop(0)
+            self._transferred[buddy] = 0
+            transfer = OutgoingBlobTransfer(
+                buddy, self._conn, self._data, self._filename,
+                self._description, self._mime, ready_cb=self.__ready_cb)
+            self.transfers[buddy] = transfer
+        if not self.transfers and not self._waiting:
+            self.finished.emit()
+
+    def cancel(self):
+        '''Cancel the running transfers, and do not start the others.'''
+        self._cancelled = True
+        self.failed.extend(self._waiting)
+        self._waiting = []
+        for transfer in self.transfers.values():
+            if transfer.channel is not None:
+                transfer.cancel()
+
+    def __ready_cb(self, transfer, error):
+        if error is not None:
+            _logger.error('transfer to %s failed: %s',
+                          transfer.buddy.props.nick, error)
+            self._done(transfer, False)
+            return
+        if self._cancelled:
+            transfer.cancel()
+        transfer.connect('notify::transferred-bytes',
+                         self.__notify_transferred_bytes_cb)
+        transfer.connect('notify::state', self.__notify_state_cb)
+
+    def __notify_transferred_bytes_cb(self, transfer, pspec):
+        transferred = transfer.props.transferred_bytes
+        self.transferred_bytes += \
+            transferred - self._transferred[transfer.buddy]
+        self._transferred[transfer.buddy] = transferred
+        self.progress.emit(transfer.buddy, transferred, self.size)
+
+    def __notify_state_cb(self, transfer, pspec):
+        if transfer.props.state == FT_STATE_COMPLETED:
+            self._done(transfer, True)
+        elif transfer.props.state == FT_STATE_CANCELLED:
+            self._done(transfer, False)
+
+    def _done(self, transfer, completed):
+        if self.transfers.pop(transfer.buddy, None) is None:
+            return
+        if completed:
+            self.completed.append(transfer.buddy)
+        else:
+            self.failed.append(transfer.buddy)
+        self.start()
+
+
+def _make_patch(old, new, path=()):
+    '''
+    Return the operations turning old into new: ['set', path, value] and
+    ['del', path], where path is the list of the keys down to the value.
+    Only dicts are compared key by key; other values are replaced.
+    '''
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        if old == new:
+            return []
+        return [['set', list(path), new]]
+    patch = []
+    for key in old:
+        if key not in new:
+            patch.append(['del', list(path + (key,))])
+    for key, value in new.iteritems():
+        if key not in old:
+            patch.append(['set', list(path + (key,)), value])
+        else:
+            patch.extend(_make_patch(old[key], value, path + (key,)))
+    return patch
+
+
+def _apply_patch(data, patch):
+    '''Apply a patch from `_make_patch` to data and return the result.'''
+    for op in patch:
+        path = op[1]
+        if not path:
+            data = op[2]
+            continue
+        parent = data
+        for key in path[:-1]:
+            parent = parent[key]
+        if op[0] == 'set':
+            parent[path[-1]] = op[2]
+        else:
+            del parent[path[-1]]
+    return data
+
+
+def _get_buddy_key(buddy):
+    if isinstance(buddy, dict):
+        # One to one XMPP chat
+        return buddy.get('nick')
+    return buddy.props.key
+
+
+def _is_owner(buddy):
+    return getattr(buddy.props, 'key', None) == profile.get_pubkey()
+
+
+class JsonCodec(object):
+    '''
+    Encodes messages as json text.  Every wrapper understands it, so it
+    is used unless a compact codec was negotiated.
+    '''
+
+    name = 'json'
+    marker = None
+
+    def encode(self, msg):
+        '''Encode msg to a record for `join`.'''
+        return json.dumps(msg)
+
+    def join(self, records):
+        '''Make one text message of one or more records.'''
+        if len(records) == 1:
+            return records[0]
+        # the records are already encoded, so they are joined rather
+        # than decoded and encoded again
+        return '{"action": "%s", "messages": [%s]}' % (
+            ACTION_BATCH, ', '.join(records))
+
+    def decode(self, text):
+        '''Return the list of messages in a text message.'''
+        msg = json.loads(text)
+        if isinstance(msg, dict) and msg.get('action') == ACTION_BATCH:
+            return msg.get('messages', [])
+        return [msg]
+
+
+class CompactCodec(object):
+    '''
+    Encodes dict messages as length prefixed binary fields.  A schema
+    gives the fields of the messages with a given value of `key`, eg.
+    the "cmd" of the upload events, so only the values are sent: the
+    schema id stands for the key and the field names.  Messages that
+    do not match a schema exactly are sent as json inside the record.
+    The records are base64 encoded, as text messages must be text.
+    Both sides must be built with the same schemas, which is checked by
+    the codec name.
+    Args:
+        schemas (list), pairs of the value of `key` and the list of the
+            other fields of those messages, at most 255 of them
+        key (str), the field that selects the schema
+    '''
+
+    marker = '~'
+
+    def __init__(self, schemas, key='cmd'):
+        self._key = key
+        # value of key -> (schema id, fields), and schema id -> the same
+        self._by_value = {}
+        self._by_id = {}
+        for schema_id, (value, fields) in enumerate(schemas, 1):
+            self._by_value[value] = (schema_id, tuple(fields))
+            self._by_id[schema_id] = (value, tuple(fields))
+        digest = hashlib.sha1(repr((key, schemas))).hexdigest()
+        self.name = 'compact-' + digest[:8]
+
+    def encode(self, msg):
+        schema = None
+        if isinstance(msg, dict):
+            schema = self._by_value.get(msg.get(self._key))
+        if schema is not None:
+            schema_id, fields = schema
+            if len(msg) == len(fields) + 1:
+                try:
+                    return chr(schema_id) + ''.join(
+                        [_pack_value(msg[field]) for field in fields])
+                except (KeyError, TypeError):
+                    pass
+        return '\0' + _pack_bytes(json.dumps(msg))
+
+    def join(self, records):
+        return self.marker + base64.b64encode(''.join(records))
+
+    def decode(self, text):
+        data = base64.b64decode(text[len(self.marker):])
+        messages = []
+        offset = 0
+        while offset < len(data):
+            schema_id = ord(data[offset])
+            offset += 1
+            if schema_id == 0:
+                text, offset = _unpack_bytes(data, offset)
+                messages.append(json.loads(text))
+                continue
+            value, fields = self._by_id[schema_id]
+            msg = {self._key: value}
+            for field in fields:
+                msg[field], offset = _unpack_value(data, offset)
+            messages.append(msg)
+        return messages
+
+
+def _pack_varint(n):
+    data = []
+    while n > 0x7f:
+        data.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    data.append(chr(n))
+    return ''.join(data)
+
+
+def _unpack_varint(data, offset):
+    n = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, offset
+        shift += 7
+
+
+def _pack_bytes(data):
+    return _pack_varint(len(data)) + data
+
+
+def _unpack_bytes(data, offset):
+    length, offset = _unpack_varint(data, offset)
+    return data[offset:offset + length], offset + length
+
+
+def _pack_value(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        if len(value) < 0x80:
+            return 's' + chr(len(value)) + value
+        return 's' + _pack_bytes(value)
+    elif value is None:
+        return 'n'
+    elif value is True:
+        return 't'
+    elif value is False:
+        return 'f'
+    elif isinstance(value, (int, long)):
+        # zigzag, so that small negative numbers stay short
+        return 'i' + _pack_varint(value << 1 if value >= 0
+                                  else (-value << 1) - 1)
+    elif isinstance(value, float):
+        return 'd' + struct.pack('!d', value)
+    raise TypeError('no compact encoding for %r' % type(value))
+
+
+def _unpack_value(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == 'n':
+        return None, offset
+    elif tag == 't':
+        return True, offset
+    elif tag == 'f':
+        return False, offset
+    elif tag == 'i':
+        n, offset = _unpack_varint(data, offset)
+        return (n >> 1 if not n & 1 else -((n + 1) >> 1)), offset
+    elif tag == 's':
+        value, offset = _unpack_bytes(data, offset)
+        return value.decode('utf-8'), offset
+    elif tag == 'd':
+        return struct.unpack('!d', data[offset:offset + 8])[0], offset + 8
+    raise ValueError('bad compact field %r' % tag)
+
+
 class _TextChannelWrapper(object):
     '''Wrapper for a telepathy Text Channel'''
 
-    def __init__(self, text_chan, conn):
+    def __init__(self, text_chan, conn, batch_interval=None,
+                 batch_max_bytes=BATCH_MAX_BYTES, codecs=()):
         '''Connect to the text channel'''
         self._activity_cb = None
         self._activity_close_cb = None
@@ -662,10 +1507,89 @@ class _TextChannelWrapper(object):
             'Closed', self._closed_cb)
         self._signal_matches.append(m)
 
+        # sender handle -> buddy, and what resolving them needs
+        self._buddies = {}
+        self._tp_connection = None
+        self._self_handles = None
+        self._group_flags = None
+        self.buddy_cache_hits = 0
+        self.buddy_cache_misses = 0
+        try:
+            group = self._text_chan[CHANNEL_INTERFACE_GROUP]
+        except Exception:
+            # One to one XMPP chat
+            self._group = None
+        else:
+            self._group = group
+            m = group.connect_to_signal('MembersChanged',
+                                        self.__members_changed_cb)
+            self._signal_matches.append(m)
+            m = group.connect_to_signal('GroupFlagsChanged',
+                                        self.__group_flags_changed_cb)
+            self._signal_matches.append(m)
+
+        # the codecs messages can be received in, and the one they are
+        # sent in
+        self._json = JsonCodec()
+        self.codecs = [self._json] + list(codecs)
+        self._codec = self._json
+
+        self._batch_interval = batch_interval
+        self._batch_max_bytes = batch_max_bytes
+        # encoded messages waiting for the batch to be sent
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_timeout = None
+        # Send calls not made because messages went out together
+        self.dbus_calls_saved = 0
+
     def post(self, msg):
         if msg is not None:
             _logger.debug('post')
-            self._send(json.dumps(msg))
+            record = self._codec.encode(msg)
+            if self._batch_interval is None:
+                self._send(self._codec.join([record]))
+            else:
+                self._add_to_batch(record)
+
+    def set_codec(self, codec):
+        '''Send the next messages with codec, or json if it is None.'''
+        codec = codec or self._json
+        if codec is not self._codec:
+            _logger.debug('sending messages as %s', codec.name)
+            # the batch was encoded with the old codec
+            self.flush()
+            self._codec = codec
+
+    def _add_to_batch(self, text):
+        if self._batch and \
+                self._batch_bytes + len(text) > self._batch_max_bytes:
+            self.flush()
+        self._batch.append(text)
+        self._batch_bytes += len(text) + 1
+        if self._batch_bytes >= self._batch_max_bytes:
+            self.flush()
+        elif self._batch_timeout is None:
+            self._batch_timeout = GLib.timeout_add(
+                self._batch_interval, self.__batch_timeout_cb)
+
+    def __batch_timeout_cb(self):
+        self._batch_timeout = None
+        self.flush()
+        return False
+
+    def flush(self):
+        '''Send the messages waiting in the batch now.'''
+        if self._batch_timeout is not None:
+            GLib.source_remove(self._batch_timeout)
+            self._batch_timeout = None
+        if not self._batch:
+            return
+        text = self._codec.join(self._batch)
+        self.dbus_calls_saved += len(self._batch) - 1
+        self._batch = []
+        self._batch_bytes = 0
+        self._send(text)
 
     def _send(self, text):
         '''Send text over the Telepathy text channel.'''
@@ -678,6 +1602,7 @@ class _TextChannelWrapper(object):
     def close(self):
         '''Close the text channel.'''
         _logger.debug('Closing text channel')
+        self.flush()
         try:
             self._text_chan[CHANNEL_INTERFACE].Close()
         except Exception:
@@ -689,6 +1614,12 @@ class _TextChannelWrapper(object):
         for match in self._signal_matches:
             match.remove()
         self._signal_matches = []
+        if self._batch_timeout is not None:
+            GLib.source_remove(self._batch_timeout)
+            self._batch_timeout = None
+        self._batch = []
+        self._batch_bytes = 0
+        self._buddies = {}
         self._text_chan = None
         if self._activity_close_cb is not None:
             self._activity_close_cb()
@@ -721,25 +1652,32 @@ class _TextChannelWrapper(object):
             # Exclude any auxiliary messages
             return
 
-        msg = json.loads(text)
+        codec = self._json
+        for candidate in self.codecs:
+            if candidate.marker and text.startswith(candidate.marker):
+                codec = candidate
+        try:
+            messages = codec.decode(text)
+        except (ValueError, TypeError, KeyError, IndexError,
+                struct.error), e:
+            # eg. sent with a codec this wrapper does not have.
+            _logger.error('Cannot decode message from %r: %s', sender, e)
+            self._text_chan[
+                CHANNEL_TYPE_TEXT].AcknowledgePendingMessages([identity])
+            return
 
         if self._activity_cb:
-            try:
-                self._text_chan[CHANNEL_INTERFACE_GROUP]
-            except Exception:
-                # One to one XMPP chat
-                nick = self._conn[
-                    CONN_INTERFACE_ALIASING].RequestAliases([sender])[0]
-                buddy = {'nick': nick, 'color': '#000000,#808080'}
-                _logger.debug('exception: recieved from sender %r buddy %r' %
-                              (sender, buddy))
+            buddy = self._buddies.get(sender)
+            if buddy is not None:
+                self.buddy_cache_hits += 1
             else:
-                # XXX: cache these
-                buddy = self._get_buddy(sender)
-                _logger.debug('Else: recieved from sender %r buddy %r' %
-                              (sender, buddy))
+                self.buddy_cache_misses += 1
+                buddy = self._resolve_buddy(sender)
+                if buddy is not None:
+                    self._buddies[sender] = buddy
 
-            self._activity_cb(buddy, msg)
+            for msg in messages:
+                self._activity_cb(buddy, msg)
             self._text_chan[
                 CHANNEL_TYPE_TEXT].AcknowledgePendingMessages([identity])
         else:
@@ -754,6 +1692,41 @@ class _TextChannelWrapper(object):
         _logger.debug('set closed callback')
         self._activity_close_cb = callback
 
+    def forget_buddy(self, buddy):
+        '''
+        Drop the senders cached for buddy, so they are resolved again on
+        their next message.
+        '''
+        key = _get_buddy_key(buddy)
+        for handle, cached in self._buddies.items():
+            if _get_buddy_key(cached) == key:
+                del self._buddies[handle]
+
+    def __members_changed_cb(self, message, added, removed, local_pending,
+                             remote_pending, actor, reason):
+        for handle in removed:
+            self._buddies.pop(handle, None)
+
+    def __group_flags_changed_cb(self, added, removed):
+        if self._group_flags is not None:
+            self._group_flags = (self._group_flags | added) & ~removed
+        # the senders may have been resolved with the old flags.
+        self._buddies = {}
+
+    def _resolve_buddy(self, sender):
+        if self._group is None:
+            # One to one XMPP chat
+            nick = self._conn[
+                CONN_INTERFACE_ALIASING].RequestAliases([sender])[0]
+            buddy = {'nick': nick, 'color': '#000000,#808080'}
+            _logger.debug('exception: recieved from sender %r buddy %r' %
+                          (sender, buddy))
+        else:
+            buddy = self._get_buddy(sender)
+            _logger.debug('Else: recieved from sender %r buddy %r' %
+                          (sender, buddy))
+        return buddy
+
     def _get_buddy(self, cs_handle):
         '''Get a Buddy from a (possibly channel-specific) handle.'''
         # XXX This will be made redundant once Presence Service
@@ -762,14 +1735,22 @@ class _TextChannelWrapper(object):
         # Get the Presence Service
         pservice = presenceservice.get_instance()
 
-        # Get the Telepathy Connection
-        tp_name, tp_path = pservice.get_preferred_connection()
-        conn = Connection(tp_name, tp_path)
-        group = self._text_chan[CHANNEL_INTERFACE_GROUP]
-        my_csh = group.GetSelfHandle()
+        # Get the Telepathy Connection, and what does not change for
+        # the life of the channel
+        if self._tp_connection is None:
+            tp_name, tp_path = pservice.get_preferred_connection()
+            self._tp_connection = (tp_name, tp_path,
+                                   Connection(tp_name, tp_path))
+        tp_name, tp_path, conn = self._tp_connection
+        group = self._group
+        if self._self_handles is None:
+            self._self_handles = (group.GetSelfHandle(),
+                                  conn.GetSelfHandle())
+            self._group_flags = group.GetGroupFlags()
+        my_csh, my_handle = self._self_handles
         if my_csh == cs_handle:
-            handle = conn.GetSelfHandle()
-        elif (group.GetGroupFlags() &
+            handle = my_handle
+        elif (self._group_flags &
               CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES):
             handle = group.GetHandleOwners([cs_handle])[0]
         else:
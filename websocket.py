@@ -28,6 +28,19 @@ import uuid
 import sha
 import base64
 import logging
+import zlib
+from binascii import hexlify, unhexlify
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
 
 """
 websocket python client.
@@ -158,6 +171,12 @@ def create_connection(url, timeout=None, **options):
     websock.connect(url, **options)
     return websock
 
+# number of bytes read at a time while reading the handshake response.
+HEADER_BLOCK_SIZE = 4096
+
+# number of bytes read, masked and sent at a time by WebSocket.send_stream.
+STREAM_CHUNK_SIZE = 1 << 16
+
 _MAX_INTEGER = (1 << 32) -1
 _AVAILABLE_KEY_CHARS = range(0x21, 0x2f + 1) + range(0x3a, 0x7e + 1)
 _MAX_CHAR_BYTE = (1<<8) -1
@@ -180,10 +199,140 @@ class _SSLSocketWrapper(object):
 
     def recv(self, bufsize):
         return self.ssl.read(bufsize)
+
+    def recv_into(self, buf, nbytes = 0):
+        data = self.ssl.read(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data)
     
     def send(self, payload):
         return self.ssl.write(payload)
 
+    def sendall(self, payload):
+        view = memoryview(payload)
+        while len(view):
+            view = view[self.ssl.write(view.tobytes()):]
+
+# payloads are masked this many bytes at a time. must be a multiple of 4
+# so that every block starts on a mask key boundary.
+_MASK_BLOCK_SIZE = 1 << 16
+
+def _mask_numpy(mask_key, data):
+    length = len(data)
+    words = length // 4
+    key = numpy.frombuffer(mask_key, dtype=numpy.uint32)[0]
+    masked = numpy.frombuffer(data, dtype=numpy.uint32, count=words) ^ key
+    tail = length - words * 4
+    if not tail:
+        return masked.tostring()
+    return masked.tostring() + _mask_long(mask_key, data[words * 4:])
+
+def _mask_long(mask_key, data):
+    # xor a whole block as one big integer against the repeated mask key.
+    length = len(data)
+    if not length:
+        return ""
+    block_size = min(length, _MASK_BLOCK_SIZE)
+    block_key = long(hexlify((mask_key * (block_size // 4 + 1))[:block_size]), 16)
+    blocks = []
+    for offset in xrange(0, length, _MASK_BLOCK_SIZE):
+        block = data[offset:offset + _MASK_BLOCK_SIZE]
+        size = len(block)
+        if size == block_size:
+            key = block_key
+        else:
+            key = long(hexlify((mask_key * (size // 4 + 1))[:size]), 16)
+        value = long(hexlify(block), 16) ^ key
+        blocks.append(unhexlify("%0*x" % (size * 2, value)))
+    return "".join(blocks)
+
+def _remaining_length(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, IOError, OSError):
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        length = fileobj.tell() - position
+        fileobj.seek(position)
+        return length
+
+def _iter_chunks(source, length, chunk_size):
+    # yield memoryviews of the next length bytes of source. a file is read
+    # through one reused buffer, so each view is only valid until the next.
+    chunk = bytearray(max(chunk_size, 1))
+    chunk_view = memoryview(chunk)
+    sent = 0
+    while sent < length:
+        size = min(len(chunk), length - sent)
+        if isinstance(source, memoryview):
+            data = source[sent:sent + size]
+        else:
+            size = _read_into(source, chunk_view[:size])
+            data = chunk_view[:size]
+        if not size:
+            raise WebSocketException("stream ended after %d of %d bytes"
+                                     % (sent, length))
+        yield data
+        sent += size
+
+def _iter_stream(source, opcode, length, chunk_size, get_mask_key,
+                 deflate):
+    # yield the bytes to send for a streamed message, see
+    # WebSocket.send_stream.
+    if isinstance(source, (str, bytearray, memoryview, buffer)):
+        source = memoryview(source)
+        if length is None:
+            length = len(source)
+    elif length is None:
+        length = _remaining_length(source)
+    chunks = _iter_chunks(source, length, chunk_size)
+
+    if deflate is not None and deflate.compressing:
+        # the compressed length is not known up front, so every
+        # compressed chunk goes out as a fragment of the message.
+        rsv1 = 1
+        for data in chunks:
+            data = deflate.compress(data.tobytes())
+            if data:
+                yield _format_frame(ABNF(0, rsv1, 0, 0, opcode, 1, data),
+                                    get_mask_key)
+                opcode = ABNF.OPCODE_CONT
+                rsv1 = 0
+        yield _format_frame(ABNF(1, rsv1, 0, 0, opcode, 1, deflate.flush()),
+                            get_mask_key)
+        return
+
+    frame = ABNF(1, 0, 0, 0, opcode, 1)
+    if get_mask_key:
+        frame.get_mask_key = get_mask_key
+    mask_key = frame.get_mask_key(4)
+    yield frame.format_header(length) + mask_key
+    if traceEnabled:
+        logger.debug("send: streaming %d bytes" % length)
+
+    sent = 0
+    for data in chunks:
+        # keep the mask key aligned with the payload offset.
+        shift = sent % 4
+        key = mask_key[shift:] + mask_key[:shift]
+        yield ABNF.mask(key, data)
+        sent += len(data)
+
+def _format_frame(frame, get_mask_key):
+    if get_mask_key:
+        frame.get_mask_key = get_mask_key
+    data = frame.format()
+    if traceEnabled:
+        logger.debug("send: " + repr(data))
+    return data
+
+def _read_into(fileobj, view):
+    if hasattr(fileobj, "readinto"):
+        return fileobj.readinto(view) or 0
+    data = fileobj.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+
 _BOOL_VALUES = (0, 1)
 def _is_bool(*values):
     for v in values:
@@ -200,6 +349,7 @@ class ABNF(object):
     """
     
     # operation code values.
+    OPCODE_CONT   = 0x0
     OPCODE_TEXT   = 0x1
     OPCODE_BINARY = 0x2
     OPCODE_CLOSE  = 0x8
@@ -207,11 +357,12 @@ class ABNF(object):
     OPCODE_PONG   = 0xa
     
     # available operation code value tuple
-    OPCODES = (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE,
+    OPCODES = (OPCODE_CONT, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE,
                 OPCODE_PING, OPCODE_PONG)
 
     # opcode human readable string
     OPCODE_MAP = {
+        OPCODE_CONT: "cont",
         OPCODE_TEXT: "text",
         OPCODE_BINARY: "binary",
         OPCODE_CLOSE: "close",
@@ -255,15 +406,52 @@ class ABNF(object):
         # mask must be set if send data from client
         return ABNF(1, 0, 0, 0, opcode, 1, data)
 
+    @staticmethod
+    def create_fragments(data, opcode, fragment_size):
+        """
+        create the frames to send data as a fragmented message.
+        the first frame has the given opcode, the following ones are
+        continuation frames and only the last one has fin set.
+
+        data: data to send. see create_frame.
+
+        opcode: operation code. please see OPCODE_XXX.
+
+        fragment_size: maximum payload length of each frame.
+        """
+        if opcode == ABNF.OPCODE_TEXT and isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if fragment_size <= 0:
+            raise ValueError("fragment size must be positive")
+        length = len(data)
+        for offset in xrange(0, max(length, 1), fragment_size):
+            fin = int(offset + fragment_size >= length)
+            yield ABNF(fin, 0, 0, 0, opcode, 1,
+                       data[offset:offset + fragment_size])
+            opcode = ABNF.OPCODE_CONT
+
     def format(self):
         """
         format this object to string(byte array) to send data to server.
         """
+        frame_header = self.format_header(len(self.data))
+        if not self.mask:
+            return frame_header + self.data
+        else:
+            mask_key = self.get_mask_key(4)
+            return frame_header + self._get_masked(mask_key)
+
+    def format_header(self, length):
+        """
+        format the frame header for a payload of length bytes.
+        the mask key is not included.
+
+        length: length of the payload.
+        """
         if not _is_bool(self.fin, self.rsv1, self.rsv2, self.rsv3):
             raise ValueError("not 0 or 1")
         if self.opcode not in ABNF.OPCODES:
             raise ValueError("Invalid OPCODE")
-        length = len(self.data)
         if length >= ABNF.LENGTH_63:
             raise ValueError("data is too long")
         
@@ -278,12 +466,7 @@ class ABNF(object):
         else:
             frame_header += chr(self.mask << 7 | 0x7f)
             frame_header += struct.pack("!Q", length)
-        
-        if not self.mask:
-            return frame_header + self.data
-        else:
-            mask_key = self.get_mask_key(4)
-            return frame_header + self._get_masked(mask_key)
+        return frame_header
 
     def _get_masked(self, mask_key):
         s = ABNF.mask(mask_key, self.data)
@@ -292,18 +475,454 @@ class ABNF(object):
     @staticmethod
     def mask(mask_key, data):
         """
-        mask or unmask data. Just do xor for each byte
+        mask or unmask data. Just do xor for each byte.
+        The xor is done a word at a time, with numpy if it is available.
 
         mask_key: 4 byte string(byte).
         
         data: data to mask/unmask.
         """
-        _m = map(ord, mask_key)
-        _d = map(ord, data)
-        for i in range(len(_d)):
-            _d[i] ^= _m[i % 4]
-        s = map(chr, _d)
-        return "".join(s)
+        if numpy is not None:
+            return _mask_numpy(mask_key, data)
+        return _mask_long(mask_key, data)
+
+def _get_handshake_request(host, port, resource, **options):
+    """
+    build the opening handshake request.
+
+    return value: tuple of the Sec-WebSocket-Key, the _PerMessageDeflate
+                  that was offered or None, and the request string.
+    """
+    headers = []
+    headers.append("GET %s HTTP/1.1" % resource)
+    headers.append("Upgrade: websocket")
+    headers.append("Connection: Upgrade")
+    if port == 80:
+        hostport = host
+    else:
+        hostport = "%s:%d" % (host, port)
+    headers.append("Host: %s" % hostport)
+    headers.append("Origin: %s" % hostport)
+
+    key = _create_sec_websocket_key()
+    headers.append("Sec-WebSocket-Key: %s" % key)
+    headers.append("Sec-WebSocket-Protocol: chat, superchat")
+    headers.append("Sec-WebSocket-Version: %s" % VERSION)
+    if "header" in options:
+        headers.extend(options["header"])
+    deflate = options.get("permessage_deflate")
+    if deflate:
+        if deflate is True:
+            deflate = {}
+        deflate = _PerMessageDeflate(**deflate)
+        headers.append("Sec-WebSocket-Extensions: %s" % deflate.offer())
+    else:
+        deflate = None
+
+    headers.append("")
+    headers.append("")
+
+    return key, deflate, "\r\n".join(headers)
+
+class _HandshakeResponse(object):
+    """
+    status and headers of the handshake response, parsed one line
+    at a time.
+    """
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+
+    def feed_line(self, line):
+        """
+        parse the next line of the response.
+
+        return value: True once the blank line ending the headers is fed.
+        """
+        if line == "\r\n":
+            return True
+        line = line.strip()
+        if traceEnabled:
+            logger.debug(line)
+        if not self.status:
+            status_info = line.split(" ", 2)
+            self.status = int(status_info[1])
+        else:
+            kv = line.split(":", 1)
+            if len(kv) == 2:
+                key, value = kv
+                self.headers[key.lower()] = value.strip().lower()
+            else:
+                raise WebSocketException("Invalid header")
+        return False
+
+def _check_handshake_response(status, headers, key, deflate):
+    """
+    raise WebSocketException unless the handshake response accepts the
+    request.
+
+    return value: the _PerMessageDeflate to use, or None.
+    """
+    if status != 101:
+        raise WebSocketException("Handshake Status %d" % status)
+
+    if not _validate_header(headers, key):
+        raise WebSocketException("Invalid WebSocket Header")
+
+    extensions = headers.get("sec-websocket-extensions")
+    if not extensions:
+        return None
+    if not deflate or not deflate.accept(extensions):
+        raise WebSocketException("Unexpected extension %s" % extensions)
+    return deflate
+
+def _validate_header(headers, key):
+    for k, v in _HEADERS_TO_CHECK.iteritems():
+        r = headers.get(k, None)
+        if not r:
+            return False
+        r = r.lower()
+        if v != r:
+            return False
+
+    result = headers.get("sec-websocket-accept", None)
+    if not result:
+        return False
+    result = result.lower()
+
+    value = key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    hashed = base64.encodestring(sha.sha(value).digest()).strip().lower()
+    return hashed == result
+
+def _parse_frame_header(header_bytes):
+    """
+    parse the first 2 bytes of a frame.
+
+    return value: tuple of fin, rsv1, rsv2, rsv3, opcode, mask and the
+                  7 bit length, where 0x7e and 0x7f mean that a 2 or 8 byte
+                  length follows.
+    """
+    b1 = ord(header_bytes[0])
+    fin = b1 >> 7 & 1
+    rsv1 = b1 >> 6 & 1
+    rsv2 = b1 >> 5 & 1
+    rsv3 = b1 >> 4 & 1
+    opcode = b1 & 0xf
+    b2 = ord(header_bytes[1])
+    mask = b2 >> 7 & 1
+    length = b2 & 0x7f
+    return fin, rsv1, rsv2, rsv3, opcode, mask, length
+
+def _create_message_frames(payload, opcode, fragment_size, deflate):
+    """
+    create the frames to send a message, compressed if deflate is
+    not None and fragmented if it is longer than fragment_size.
+    """
+    if opcode == ABNF.OPCODE_TEXT and isinstance(payload, unicode):
+        payload = payload.encode("utf-8")
+    is_data = opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY)
+    compressed = is_data and deflate is not None and deflate.compressing
+    if compressed:
+        payload = deflate.compress(payload) + deflate.flush()
+    if fragment_size and len(payload) > fragment_size and is_data:
+        frames = ABNF.create_fragments(payload, opcode, fragment_size)
+    else:
+        frames = [ABNF.create_frame(payload, opcode)]
+    for frame in frames:
+        # only the first frame of a compressed message has rsv1 set.
+        frame.rsv1 = int(compressed)
+        compressed = False
+        yield frame
+
+class ABNFParser(object):
+    """
+    Push based frame parser: feed it bytes as they arrive, in pieces of
+    any size, and it returns the frames they complete.  Unlike
+    WebSocket.recv_frame it never waits for more data, so it can be
+    driven from non-blocking sockets and event loops.
+
+    >>> parser = ABNFParser()
+    >>> for frame in parser.feed(data):
+    ...     handle(frame)
+
+    chunk_size: if set, the payload of a text, binary or continuation
+      frame is returned as soon as chunk_size bytes of it have arrived,
+      instead of once the whole frame has.  The pieces are returned as
+      fragments of the message: the first keeps the opcode and rsv bits
+      of the frame, the others are continuation frames, and only the last
+      piece of a final frame has fin set.
+    """
+    def __init__(self, chunk_size = None):
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._offset = 0
+        self._parse = self._parse_header
+        self._need = 2
+        self._header = None
+        self._length = 0
+        self._mask_key = ""
+        self._received = 0
+        # bytes and frames seen, for statistics.
+        self.bytes_fed = 0
+        self.frames = 0
+
+    def feed(self, data):
+        """
+        add data received from the server.
+
+        return value: list of the ABNF frames (or pieces of frames, see
+                      chunk_size) completed by the data.
+        """
+        self._buffer += data
+        self.bytes_fed += len(data)
+        frames = []
+        while len(self._buffer) - self._offset >= self._need:
+            frame = self._parse()
+            if frame is not None:
+                frames.append(frame)
+        # drop the parsed bytes, keeping the start of the next frame.
+        del self._buffer[:self._offset]
+        self._offset = 0
+        return frames
+
+    def _take(self, size):
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return data
+
+    def _parse_header(self):
+        b1, b2 = struct.unpack_from("!BB", self._buffer, self._offset)
+        self._offset += 2
+        length = b2 & 0x7f
+        mask = b2 >> 7 & 1
+        if length < 0x7e and (len(self._buffer) - self._offset
+                              >= length + 4 * mask):
+            # the common small frame is already complete.
+            data = self._take(length + 4 * mask)
+            if mask:
+                data = ABNF.mask(str(data[:4]), data[4:])
+            self.frames += 1
+            return ABNF(b1 >> 7 & 1, b1 >> 6 & 1, b1 >> 5 & 1, b1 >> 4 & 1,
+                        b1 & 0xf, mask, data)
+        self._header = (b1 >> 7 & 1, b1 >> 6 & 1, b1 >> 5 & 1, b1 >> 4 & 1,
+                        b1 & 0xf, mask, length)
+        if length == 0x7e:
+            self._parse, self._need = self._parse_length, 2
+        elif length == 0x7f:
+            self._parse, self._need = self._parse_length, 8
+        else:
+            self._start_payload(length)
+
+    def _parse_length(self):
+        if self._need == 2:
+            length = struct.unpack_from("!H", self._buffer, self._offset)[0]
+        else:
+            length = struct.unpack_from("!Q", self._buffer, self._offset)[0]
+        self._offset += self._need
+        self._start_payload(length)
+
+    def _start_payload(self, length):
+        self._length = length
+        self._received = 0
+        if self._header[5]:
+            self._parse, self._need = self._parse_mask_key, 4
+        else:
+            self._mask_key = ""
+            self._payload_need()
+
+    def _parse_mask_key(self):
+        self._mask_key = str(self._take(4))
+        self._payload_need()
+
+    def _payload_need(self):
+        self._parse = self._parse_payload
+        remaining = self._length - self._received
+        opcode = self._header[4]
+        if (self.chunk_size and opcode not in (ABNF.OPCODE_CLOSE,
+                ABNF.OPCODE_PING, ABNF.OPCODE_PONG)):
+            remaining = min(remaining, self.chunk_size)
+        self._need = remaining
+
+    def _parse_payload(self):
+        fin, rsv1, rsv2, rsv3, opcode, mask, length = self._header
+        available = len(self._buffer) - self._offset
+        size = min(available, self._length - self._received)
+        data = self._take(size)
+        if mask:
+            # keep the mask key aligned with the payload offset.
+            shift = self._received % 4
+            data = ABNF.mask(self._mask_key[shift:] + self._mask_key[:shift],
+                             data)
+        self._received += size
+
+        if self._received < self._length:
+            frame = ABNF(0, rsv1, rsv2, rsv3, opcode, mask, data)
+            self._header = (fin, 0, 0, 0, ABNF.OPCODE_CONT, mask, length)
+            self._payload_need()
+        else:
+            frame = ABNF(fin, rsv1, rsv2, rsv3, opcode, mask, data)
+            self.frames += 1
+            self._parse, self._need = self._parse_header, 2
+        return frame
+
+class _MessageReader(object):
+    """
+    Follows the data frames of the messages being received, checking the
+    order of the fragments and inflating compressed messages.
+    """
+    def __init__(self, deflate = None):
+        self._deflate = deflate
+        self._opcode = None
+        self._compressed = False
+
+    def feed(self, frame):
+        """
+        process a text, binary or continuation frame.
+
+        return value: tuple of the operation code of the message, the
+                      data of the fragment and the fin flag.
+        """
+        if frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            if self._opcode is not None:
+                raise WebSocketException("Expected a continuation frame")
+            self._opcode = frame.opcode
+            self._compressed = bool(frame.rsv1)
+            if self._compressed and self._deflate is None:
+                raise WebSocketException("Compressed frame without "
+                                         "permessage-deflate")
+        elif frame.opcode == ABNF.OPCODE_CONT:
+            if self._opcode is None:
+                raise WebSocketException("Unexpected continuation frame")
+        else:
+            raise WebSocketException("Not a data frame %d" % frame.opcode)
+
+        opcode = self._opcode
+        data = frame.data
+        if self._compressed:
+            data = self._deflate.decompress(data, frame.fin)
+        if frame.fin:
+            self._opcode = None
+        return (opcode, data, frame.fin)
+
+# the empty stored block that ends every sync flush, see rfc7692 7.2.1.
+_DEFLATE_TAIL = "\x00\x00\xff\xff"
+
+class _PerMessageDeflate(object):
+    """
+    permessage-deflate extension.
+    see http://tools.ietf.org/html/rfc7692
+
+    One compressor and one decompressor are kept for the connection, and
+    reset after each message only if no context takeover was negotiated.
+    If the server asks for a window zlib cannot compress with, the
+    messages sent are left uncompressed, which rfc7692 allows.
+    """
+    def __init__(self, client_max_window_bits = None,
+                 server_max_window_bits = None,
+                 client_no_context_takeover = False,
+                 server_no_context_takeover = False,
+                 level = zlib.Z_DEFAULT_COMPRESSION):
+        self.client_max_window_bits = client_max_window_bits
+        self.server_max_window_bits = server_max_window_bits
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_no_context_takeover = server_no_context_takeover
+        self.level = level
+        self.compressing = True
+        self._compressor = None
+        self._decompressor = None
+
+    def offer(self):
+        """
+        return the Sec-WebSocket-Extensions header value to request.
+        """
+        params = ["permessage-deflate"]
+        if self.client_max_window_bits:
+            params.append("client_max_window_bits=%d"
+                          % self.client_max_window_bits)
+        else:
+            params.append("client_max_window_bits")
+        if self.server_max_window_bits:
+            params.append("server_max_window_bits=%d"
+                          % self.server_max_window_bits)
+        if self.client_no_context_takeover:
+            params.append("client_no_context_takeover")
+        if self.server_no_context_takeover:
+            params.append("server_no_context_takeover")
+        return "; ".join(params)
+
+    def accept(self, response):
+        """
+        apply the parameters the server answered with.
+
+        response: Sec-WebSocket-Extensions header value of the response.
+
+        return value: True if the server accepted permessage-deflate.
+        """
+        for extension in response.split(","):
+            params = [p.strip() for p in extension.split(";")]
+            if params[0] != "permessage-deflate":
+                continue
+            for param in params[1:]:
+                name, _, value = param.partition("=")
+                name = name.strip()
+                value = value.strip().strip('"')
+                if name == "client_no_context_takeover":
+                    self.client_no_context_takeover = True
+                elif name == "server_no_context_takeover":
+                    self.server_no_context_takeover = True
+                elif name == "client_max_window_bits" and value:
+                    self.client_max_window_bits = int(value)
+                elif name == "server_max_window_bits" and value:
+                    self.server_max_window_bits = int(value)
+                else:
+                    raise WebSocketException(
+                        "Invalid permessage-deflate parameter %s" % name)
+            # zlib does not support raw deflate with an 8 bit window.
+            if self.client_max_window_bits and \
+                    self.client_max_window_bits < 9:
+                logger.debug("client_max_window_bits=%d is not supported, "
+                             "not compressing" % self.client_max_window_bits)
+                self.compressing = False
+            return True
+        return False
+
+    def compress(self, data):
+        """
+        compress part of a message. call flush at the end of the message.
+        """
+        if self._compressor is None:
+            bits = min(self.client_max_window_bits or zlib.MAX_WBITS,
+                       zlib.MAX_WBITS)
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                                -bits)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """
+        return the rest of the compressed message.
+        """
+        if self._compressor is None:
+            self.compress("")
+        data = self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.client_no_context_takeover:
+            self._compressor = None
+        return data[:-len(_DEFLATE_TAIL)]
+
+    def decompress(self, data, fin):
+        """
+        decompress a fragment of a message.
+
+        fin: True for the last fragment of the message.
+        """
+        if self._decompressor is None:
+            # the largest window can inflate data from any smaller one.
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = self._decompressor.decompress(str(data))
+        if fin:
+            data += self._decompressor.decompress(_DEFLATE_TAIL)
+            if self.server_no_context_takeover:
+                self._decompressor = None
+        return data
 
 class WebSocket(object):
     """
@@ -325,14 +944,26 @@ class WebSocket(object):
     
     get_mask_key: a callable to produce new mask keys, see the set_mask_key 
       function's docstring for more details
+
+    fragment_size: if set, text and binary messages longer than this are
+      sent as several frames of at most this many bytes.
     """
-    def __init__(self, get_mask_key = None):
+    def __init__(self, get_mask_key = None, fragment_size = None):
         """
         Initalize WebSocket object.
         """
         self.connected = False
         self.io_sock = self.sock = socket.socket()
         self.get_mask_key = get_mask_key
+        self.fragment_size = fragment_size
+        # _PerMessageDeflate when the server accepted compression.
+        self._deflate = None
+        # bytes read from the socket but not consumed yet.
+        self._recv_buffer = ""
+        # number of recv calls made on the socket, and how many of them
+        # the last handshake needed.
+        self.recv_calls = 0
+        self.handshake_recv_calls = 0
         
     def set_mask_key(self, func):
         """
@@ -374,9 +1005,14 @@ class WebSocket(object):
                  if you set None for this value,
                  it means "use default_timeout value"
 
-        options: current support option is only "header".
+        options: "header" and "permessage_deflate" are supported.
                  if you set header as dict value,
                  the custom HTTP headers are added.
+                 if you set permessage_deflate as True, or as a dict of
+                 client_max_window_bits, server_max_window_bits,
+                 client_no_context_takeover, server_no_context_takeover
+                 and level, messages are compressed when the server
+                 supports it.
 
         """
         hostname, port, resource, is_secure = _parse_url(url)
@@ -388,28 +1024,9 @@ class WebSocket(object):
 
     def _handshake(self, host, port, resource, **options):
         sock = self.io_sock
-        headers = []
-        headers.append("GET %s HTTP/1.1" % resource)
-        headers.append("Upgrade: websocket")
-        headers.append("Connection: Upgrade")
-        if port == 80:
-            hostport = host
-        else:
-            hostport = "%s:%d" % (host, port)
-        headers.append("Host: %s" % hostport)
-        headers.append("Origin: %s" % hostport)
-   
-        key = _create_sec_websocket_key()
-        headers.append("Sec-WebSocket-Key: %s" % key)
-        headers.append("Sec-WebSocket-Protocol: chat, superchat")
-        headers.append("Sec-WebSocket-Version: %s" % VERSION)
-        if "header" in options:
-            headers.extend(options["header"])
-
-        headers.append("")
-        headers.append("")
-
-        header_str = "\r\n".join(headers)
+        handshake_start = self.recv_calls
+        key, deflate, header_str = _get_handshake_request(
+            host, port, resource, **options)
         sock.send(header_str)
         if traceEnabled:
             logger.debug( "--- request header ---")
@@ -417,63 +1034,28 @@ class WebSocket(object):
             logger.debug("-----------------------")
 
         status, resp_headers = self._read_headers()
-        if status != 101:
-            self.close()
-            raise WebSocketException("Handshake Status %d" % status)
-
-        success = self._validate_header(resp_headers, key)
-        if not success:
+        self.handshake_recv_calls = self.recv_calls - handshake_start
+        try:
+            self._deflate = _check_handshake_response(status, resp_headers,
+                                                      key, deflate)
+        except WebSocketException:
             self.close()
-            raise WebSocketException("Invalid WebSocket Header")
+            raise
 
         self.connected = True
-    
-    def _validate_header(self, headers, key):
-        for k, v in _HEADERS_TO_CHECK.iteritems():
-            r = headers.get(k, None)
-            if not r:
-                return False
-            r = r.lower()
-            if v != r:
-                return False
-
-        result = headers.get("sec-websocket-accept", None)
-        if not result:
-            return False
-        result = result.lower()
-        
-        value = key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-        hashed = base64.encodestring(sha.sha(value).digest()).strip().lower()
-        return hashed == result
 
     def _read_headers(self):
-        status = None
-        headers = {}
+        response = _HandshakeResponse()
         if traceEnabled:
             logger.debug("--- response header ---")
             
-        while True:
-            line = self._recv_line()
-            if line == "\r\n":
-                break
-            line = line.strip()
-            if traceEnabled:
-                logger.debug(line)
-            if not status:
-                status_info = line.split(" ", 2)
-                status = int(status_info[1])
-            else:
-                kv = line.split(":", 1)
-                if len(kv) == 2:
-                    key, value = kv
-                    headers[key.lower()] = value.strip().lower()
-                else:
-                    raise WebSocketException("Invalid header")
+        while not response.feed_line(self._recv_line()):
+            pass
 
         if traceEnabled:
             logger.debug("-----------------------")
         
-        return status, headers    
+        return response.status, response.headers
     
     def send(self, payload, opcode = ABNF.OPCODE_TEXT):
         """
@@ -485,13 +1067,35 @@ class WebSocket(object):
 
         opcode: operation code to send. Please see OPCODE_XXX.
         """
-        frame = ABNF.create_frame(payload, opcode)
-        if self.get_mask_key:
-            frame.get_mask_key = self.get_mask_key
-        data = frame.format()
-        self.io_sock.send(data)
-        if traceEnabled:
-            logger.debug("send: " + repr(data))
+        for frame in _create_message_frames(payload, opcode,
+                                            self.fragment_size,
+                                            self._deflate):
+            self._send_frame(frame)
+
+    def _send_frame(self, frame):
+        self.io_sock.sendall(_format_frame(frame, self.get_mask_key))
+
+    def send_stream(self, source, opcode = ABNF.OPCODE_BINARY, length = None,
+                    chunk_size = STREAM_CHUNK_SIZE):
+        """
+        Send the data of a file-like object or a buffer as one frame.
+        The payload is read, masked and sent chunk_size bytes at a time
+        through one reused buffer, so memory use does not depend on the
+        size of the payload.
+
+        source: file-like object to read the payload from,
+                or string, bytearray or memoryview.
+
+        opcode: operation code to send. Please see OPCODE_XXX.
+
+        length: number of bytes to send. If None, everything from the
+                current position of the file, or the whole buffer, is sent.
+
+        chunk_size: number of bytes to read and send at a time.
+        """
+        for data in _iter_stream(source, opcode, length, chunk_size,
+                                 self.get_mask_key, self._deflate):
+            self.io_sock.sendall(data)
 
     def ping(self, payload = ""):
         """
@@ -521,54 +1125,78 @@ class WebSocket(object):
     def recv_data(self):
         """
         Recieve data with operation code.
+        Fragmented messages are reassembled.
         
         return  value: tuple of operation code and string(byte array) value.
         """
+        fragments = []
+        for opcode, data, fin in self.recv_fragments():
+            if data is None:
+                return (opcode, None)
+            fragments.append(str(data))
+        return (opcode, "".join(fragments))
+
+    def recv_fragments(self):
+        """
+        Recieve the next message fragment by fragment, as the frames
+        arrive, so that a large message is never held in memory at once.
+        Control frames that arrive between the fragments are handled.
+
+        >>> for opcode, data, fin in ws.recv_fragments():
+        ...     output.write(data)
+
+        return value: iterator of tuples of the operation code of the
+                      message, the data of the fragment(bytearray, or
+                      string if the message was compressed) and
+                      the fin flag. If the connection is closed,
+                      the data is None.
+        """
+        message = _MessageReader(self._deflate)
         while True:
             frame = self.recv_frame()
             if not frame:
                 # handle error: 
                 # 'NoneType' object has no attribute 'opcode'
                 raise WebSocketException("Not a valid frame %s" % frame)
-            elif frame.opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
-                return (frame.opcode, frame.data)
             elif frame.opcode == ABNF.OPCODE_CLOSE:
                 self.send_close()
-                return (frame.opcode, None)
+                yield (frame.opcode, None, 1)
+                return
             elif frame.opcode == ABNF.OPCODE_PING:
                 self.pong("Hi!")
-
+            elif frame.opcode != ABNF.OPCODE_PONG:
+                fragment = message.feed(frame)
+                yield fragment
+                if fragment[2]:
+                    return
 
     def recv_frame(self):
         """
         recieve data as frame from server.
 
-        return value: ABNF frame object.
+        return value: ABNF frame object. Unless the frame was masked,
+                      its data is the receive buffer(bytearray) itself.
         """
         header_bytes = self._recv(2)
         if not header_bytes:
             return None
-        b1 = ord(header_bytes[0])
-        fin = b1 >> 7 & 1
-        rsv1 = b1 >> 6 & 1
-        rsv2 = b1 >> 5 & 1
-        rsv3 = b1 >> 4 & 1
-        opcode = b1 & 0xf
-        b2 = ord(header_bytes[1])
-        mask = b2 >> 7 & 1
-        length = b2 & 0x7f
+        if len(header_bytes) < 2:
+            header_bytes += str(self._recv_strict(1))
+        fin, rsv1, rsv2, rsv3, opcode, mask, length = \
+            _parse_frame_header(header_bytes)
 
         length_data = ""
         if length == 0x7e:
-            length_data = self._recv(2)
+            length_data = str(self._recv_strict(2))
             length = struct.unpack("!H", length_data)[0]
         elif length == 0x7f:
-            length_data = self._recv(8)
+            length_data = str(self._recv_strict(8))
             length = struct.unpack("!Q", length_data)[0]
 
         mask_key = ""
         if mask:
-            mask_key = self._recv(4)
+            mask_key = str(self._recv_strict(4))
+        # data is the receive buffer itself, it is not copied into a string.
         data = self._recv_strict(length)
         if traceEnabled:
             recieved = header_bytes + length_data + mask_key + data
@@ -624,31 +1252,277 @@ class WebSocket(object):
 
     def _closeInternal(self):
         self.connected = False
+        self._recv_buffer = ""
         self.sock.close()
         self.io_sock = self.sock
         
     def _recv(self, bufsize):
+        if self._recv_buffer:
+            bytes = self._recv_buffer[:bufsize]
+            self._recv_buffer = self._recv_buffer[bufsize:]
+            return bytes
+        self.recv_calls += 1
         bytes = self.io_sock.recv(bufsize)
         return bytes
 
     def _recv_strict(self, bufsize):
-        remaining = bufsize
-        bytes = ""
-        while remaining:
-            bytes += self._recv(remaining)
-            remaining = bufsize - len(bytes)
-            
+        # fill one preallocated buffer, so that a frame arriving in many
+        # segments is not copied again for every segment.
+        bytes = bytearray(bufsize)
+        view = memoryview(bytes)
+        received = len(self._recv_buffer[:bufsize])
+        if received:
+            view[:received] = self._recv(received)
+        while received < bufsize:
+            self.recv_calls += 1
+            n = self.io_sock.recv_into(view[received:], bufsize - received)
+            if not n:
+                raise WebSocketException("connection is already closed.")
+            received += n
+
         return bytes
 
     def _recv_line(self):
-        line = []
+        # read whole blocks and split the lines out of them. whatever
+        # follows the last line stays buffered for recv_frame.
         while True:
-            c = self._recv(1)
-            line.append(c)
-            if c == "\n":
+            end = self._recv_buffer.find("\n")
+            if end >= 0:
                 break
-        return "".join(line)
+            self.recv_calls += 1
+            bytes = self.io_sock.recv(HEADER_BLOCK_SIZE)
+            if not bytes:
+                raise WebSocketException("connection is already closed.")
+            self._recv_buffer += bytes
+        line = self._recv_buffer[:end + 1]
+        self._recv_buffer = self._recv_buffer[end + 1:]
+        return line
             
+def _coroutine(func):
+    if asyncio is None:
+        return func
+    return asyncio.coroutine(func)
+
+class AsyncWebSocket(object):
+    """
+    WebSocket interface for asyncio(trollius) event loops.
+    Every operation is a coroutine, so that many connections can share
+    one loop instead of using a thread each.
+
+    >>> ws = AsyncWebSocket()
+    >>> yield From(ws.connect("ws://echo.websocket.org"))
+    >>> yield From(ws.send("Hello, Server"))
+    >>> data = yield From(ws.recv())
+    >>> yield From(ws.close())
+
+    get_mask_key: a callable to produce new mask keys, see the
+      WebSocket.set_mask_key's docstring for more details
+
+    fragment_size: if set, text and binary messages longer than this are
+      sent as several frames of at most this many bytes.
+
+    loop: the event loop to use, the default one if None.
+    """
+    def __init__(self, get_mask_key = None, fragment_size = None,
+                 loop = None):
+        if asyncio is None:
+            raise WebSocketException("AsyncWebSocket needs trollius")
+        self.connected = False
+        self.get_mask_key = get_mask_key
+        self.fragment_size = fragment_size
+        self.loop = loop
+        self._reader = None
+        self._writer = None
+        self._deflate = None
+
+    @_coroutine
+    def connect(self, url, **options):
+        """
+        Connect to url. url is websocket url scheme. ie. ws://host:port/resource
+
+        options: the same as for WebSocket.connect.
+        """
+        hostname, port, resource, is_secure = _parse_url(url)
+        self._reader, self._writer = yield From(asyncio.open_connection(
+            hostname, port, ssl = is_secure or None, loop = self.loop))
+        key, deflate, header_str = _get_handshake_request(
+            hostname, port, resource, **options)
+        self._writer.write(header_str)
+        if traceEnabled:
+            logger.debug( "--- request header ---")
+            logger.debug( header_str)
+            logger.debug("-----------------------")
+
+        response = _HandshakeResponse()
+        while True:
+            line = yield From(self._reader.readline())
+            if not line:
+                self._closeInternal()
+                raise WebSocketException("connection is already closed.")
+            if response.feed_line(line):
+                break
+        try:
+            self._deflate = _check_handshake_response(
+                response.status, response.headers, key, deflate)
+        except WebSocketException:
+            self._closeInternal()
+            raise
+
+        self.connected = True
+
+    @_coroutine
+    def send(self, payload, opcode = ABNF.OPCODE_TEXT):
+        """
+        Send the data as string. Waits while the transport buffer is full.
+
+        payload: Payload must be utf-8 string or unicoce,
+                  if the opcode is OPCODE_TEXT.
+                  Otherwise, it must be string(byte array)
+
+        opcode: operation code to send. Please see OPCODE_XXX.
+        """
+        for frame in _create_message_frames(payload, opcode,
+                                            self.fragment_size,
+                                            self._deflate):
+            self._writer.write(_format_frame(frame, self.get_mask_key))
+            yield From(self._writer.drain())
+
+    @_coroutine
+    def ping(self, payload = ""):
+        """
+        send ping data.
+        """
+        yield From(self.send(payload, ABNF.OPCODE_PING))
+
+    @_coroutine
+    def pong(self, payload):
+        """
+        send pong data.
+        """
+        yield From(self.send(payload, ABNF.OPCODE_PONG))
+
+    @_coroutine
+    def recv(self):
+        """
+        Receive string data(byte array) from the server.
+        """
+        opcode, data = yield From(self.recv_data())
+        raise Return(data)
+
+    @_coroutine
+    def recv_data(self):
+        """
+        Recieve data with operation code.
+        Fragmented messages are reassembled.
+
+        return  value: tuple of operation code and string(byte array) value.
+                       If the connection is closed, the data is None.
+        """
+        message = _MessageReader(self._deflate)
+        fragments = []
+        while True:
+            frame = yield From(self.recv_frame())
+            if frame.opcode == ABNF.OPCODE_CLOSE:
+                yield From(self.send_close())
+                raise Return((frame.opcode, None))
+            elif frame.opcode == ABNF.OPCODE_PING:
+                yield From(self.pong("Hi!"))
+            elif frame.opcode != ABNF.OPCODE_PONG:
+                opcode, data, fin = message.feed(frame)
+                fragments.append(str(data))
+                if fin:
+                    raise Return((opcode, "".join(fragments)))
+
+    @_coroutine
+    def recv_frame(self):
+        """
+        recieve data as frame from server.
+
+        return value: ABNF frame object.
+        """
+        try:
+            header_bytes = yield From(self._reader.readexactly(2))
+            fin, rsv1, rsv2, rsv3, opcode, mask, length = \
+                _parse_frame_header(header_bytes)
+            length_data = ""
+            if length == 0x7e:
+                length_data = yield From(self._reader.readexactly(2))
+                length = struct.unpack("!H", length_data)[0]
+            elif length == 0x7f:
+                length_data = yield From(self._reader.readexactly(8))
+                length = struct.unpack("!Q", length_data)[0]
+            mask_key = ""
+            if mask:
+                mask_key = yield From(self._reader.readexactly(4))
+            data = yield From(self._reader.readexactly(length))
+        except asyncio.IncompleteReadError:
+            raise WebSocketException("connection is already closed.")
+        if traceEnabled:
+            recieved = header_bytes + length_data + mask_key + data
+            logger.debug("recv: " + repr(recieved))
+
+        if mask:
+            data = ABNF.mask(mask_key, data)
+        raise Return(ABNF(fin, rsv1, rsv2, rsv3, opcode, mask, data))
+
+    @_coroutine
+    def send_close(self, status = STATUS_NORMAL, reason = ""):
+        """
+        send close data to the server.
+
+        status: status code to send. see STATUS_XXX.
+
+        reason: the reason to close. This must be string.
+        """
+        if status < 0 or status >= ABNF.LENGTH_16:
+            raise ValueError("code is invalid range")
+        yield From(self.send(struct.pack('!H', status) + reason,
+                             ABNF.OPCODE_CLOSE))
+
+    @_coroutine
+    def close(self, status = STATUS_NORMAL, reason = ""):
+        """
+        Close Websocket object, waiting at most 3 seconds for the
+        server to answer the close frame.
+
+        status: status code to send. see STATUS_XXX.
+
+        reason: the reason to close. This must be string.
+        """
+        if self.connected:
+            try:
+                yield From(self.send_close(status, reason))
+                frame = yield From(asyncio.wait_for(self.recv_frame(), 3,
+                                                    loop = self.loop))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.error("close status: " + repr(frame.data))
+            except ValueError:
+                raise
+            except Exception:
+                pass
+        self._closeInternal()
+
+    def _closeInternal(self):
+        self.connected = False
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+@_coroutine
+def create_async_connection(url, loop = None, **options):
+    """
+    connect to url with an AsyncWebSocket and return it, see
+    create_connection.
+
+    loop: the event loop to use, the default one if None.
+
+    options: the same as for WebSocket.connect.
+    """
+    websock = AsyncWebSocket(loop = loop)
+    yield From(websock.connect(url, **options))
+    raise Return(websock)
+
+
 class WebSocketApp(object):
     """
     Higher level of APIs are provided. 